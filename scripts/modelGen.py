@@ -23,9 +23,18 @@ class DawuapMonteCarlo(object):
         with open(self.param_files) as json_data:
             dat = json.load(json_data)
 
-        for feat in dat.values():
-
-            arr = utilsRaster.RasterParameterIO("../params/" + feat).array
+        fns = dict((name, "../params/" + feat) for name, feat in dat.items())
+        dataset = utilsRaster.ModelRasterDatasetHBV(fns.values()[0],
+                                                    fn_temp_thres=fns.get('pp_temp_thres'),
+                                                    fn_ddf=fns.get('ddf'),
+                                                    fn_soil_max_wat=fns.get('soil_max_wat'),
+                                                    fn_soil_beta=fns.get('soil_beta'),
+                                                    fn_aet_lp_param=fns.get('aet_lp_param'))
+        cube = utilsRaster.HBVParameterCube(dataset)
+
+        for name, feat in dat.items():
+
+            arr = cube[name]
             val = np.unique(arr.squeeze())
             by_val = val/2.
 
@@ -41,20 +50,8 @@ class DawuapMonteCarlo(object):
         out_df = pd.DataFrame()
 
         dat = utilsVector.VectorParameterIO("../params/subsout.shp")
-        hbv_ck0 = np.zeros(1)
-        hbv_ck1 = np.zeros(1)
-        hbv_ck2 = np.zeros(1)
-        hbv_hl1 = np.zeros(1)
-        hbv_perc = np.zeros(1)
-        hbv_pbase = np.zeros(1)
-
-        for feat in dat.read_features():
-            hbv_ck0 = np.append(hbv_ck0, feat['properties']['hbv_ck0'])
-            hbv_ck1 = np.append(hbv_ck1, feat['properties']['hbv_ck1'])
-            hbv_ck2 = np.append(hbv_ck2, feat['properties']['hbv_ck2'])
-            hbv_hl1 = np.append(hbv_hl1, feat['properties']['hbv_hl1'])
-            hbv_perc = np.append(hbv_perc, feat['properties']['hbv_perc'])
-            hbv_pbase = np.append(hbv_pbase, feat['properties']['hbv_pbase'])
+        hbv_ck0, hbv_ck1, hbv_ck2, hbv_hl1, hbv_perc, hbv_pbase = \
+            dat.get_parameters(['hbv_ck0', 'hbv_ck1', 'hbv_ck2', 'hbv_hl1', 'hbv_perc', 'hbv_pbase'])
 
         hbv_ck0 = np.unique(hbv_ck0[hbv_ck0 != 0.])
         hbv_ck1 = np.unique(hbv_ck1[hbv_ck1 != 0.])
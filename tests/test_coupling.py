@@ -0,0 +1,309 @@
+from utils import coupling
+from utils import utilsRaster
+from utils.crop_coefficient import retrieve_crop_coefficient
+from dateutil import parser
+import datetime
+import multiprocessing
+from affine import Affine
+import numpy as np
+import fiona
+import tempfile
+import shutil
+import os
+import nose
+
+
+class SimulatedFarm(object):
+    """Farm with the attributes set by a simulated economic scenario"""
+    def __init__(self, source_id, n_crops, rs):
+        self.source_id = source_id
+        self.name = 'farm_%i' % source_id
+        self.crop_start_date = ['4/%i/2013' % (1 + 3 * c) for c in range(n_crops)]
+        self.crop_cover_date = ['6/%i/2013' % (10 + c) for c in range(n_crops)]
+        self.crop_end_date = ['8/%i/2013' % (20 + c) for c in range(n_crops)]
+        self.crop_id = [1 + c for c in range(n_crops)]
+        self.irr_eff = rs.uniform(0.5, 0.9, n_crops)
+        self.irr = np.ones(n_crops)
+        self.watersim = rs.uniform(1e4, 1e5, n_crops)
+
+
+def build_farm_coupling(n_nodes=6, shape=(30, 40), active_cells=None, seed=2, seeds=None):
+    """Couples three farms, the last one without irrigated pixels, to a network of ``n_nodes``. With
+    ``seeds``, the farms are simulated once per seed and coupled in batched mode"""
+    water_users = [{'id': 10, 'source_id': 2}, {'id': 11, 'source_id': 5}, {'id': 12, 'source_id': 2}]
+    incidence = coupling.WaterUserIncidence(np.arange(1, n_nodes + 1), [u['source_id'] for u in water_users])
+    scenario_farms = []
+    for s in ([seed] if seeds is None else seeds):
+        rs = np.random.RandomState(s)
+        scenario_farms.append([SimulatedFarm(water_users[i]['source_id'], 3, rs) for i in incidence.user_index])
+    mask = np.zeros(shape)
+    mask[2:12, 3:15] = 10
+    mask[15:25, 20:35] = 11
+    return coupling.FarmCoupling(water_users, scenario_farms[0], incidence, mask, active_cells,
+                                 scenario_farms=None if seeds is None else scenario_farms)
+
+
+class TestFarmCoupling(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.farms = build_farm_coupling()
+        cls.land_use = np.random.RandomState(1).randint(0, 4, cls.farms.water_user_mask.shape)
+
+    def test_supplemental_irrigation(self):
+
+        farms = TestFarmCoupling.farms
+        lu = TestFarmCoupling.land_use
+        Dtot, D = farms.retrieve_water_diversion_per_node('06/01/2013')
+        res = farms.retrieve_supplemental_irrigation_map(lu, [1, 2], D)
+
+        irrigated = np.isin(lu, [1, 2])
+        for i, farm_id in enumerate([10, 11]):
+            cells = irrigated & (farms.water_user_mask == farm_id)
+            applied = D[:, i].sum()
+            np.testing.assert_allclose(res[cells], applied / np.count_nonzero(cells))
+            np.testing.assert_allclose(res[cells].sum(), applied)
+        np.testing.assert_array_equal(res[~irrigated], 0)
+
+    def test_precomputed_irrigated_land(self):
+
+        farms = build_farm_coupling()
+        lu = TestFarmCoupling.land_use
+        Dtot, D = farms.retrieve_water_diversion_per_node('07/01/2013')
+        expected = farms.retrieve_supplemental_irrigation_map(lu, [1, 2], D).copy()
+
+        farms.set_irrigated_land(lu, [1, 2])
+        np.testing.assert_array_equal(farms.retrieve_supplemental_irrigation_map(None, None, D), expected)
+        np.testing.assert_array_equal(farms._irrigated_count, [np.count_nonzero(
+            np.isin(lu, [1, 2]) & (farms.water_user_mask == farm_id)) for farm_id in [10, 11, 12]])
+
+    def test_diversions_per_node(self):
+
+        farms = TestFarmCoupling.farms
+        Dtot, D = farms.retrieve_water_diversion_per_node('06/01/2013')
+        nose.tools.assert_equals(D.shape, (6, 3))
+        np.testing.assert_array_equal(Dtot[0], np.arange(1, 7))
+        np.testing.assert_allclose(Dtot[1], np.asarray(D.sum(axis=1)).ravel())
+        # farms 10 and 12 divert from node 2 and farm 11 from node 5
+        np.testing.assert_array_equal(D.toarray() != 0, [[0, 0, 0], [1, 0, 1], [0, 0, 0],
+                                                          [0, 0, 0], [0, 1, 0], [0, 0, 0]])
+
+    def test_season_table(self):
+
+        farms = build_farm_coupling()
+        expected = [farms.retrieve_water_diversion_per_node((datetime.date(2013, 3, 25) + datetime.timedelta(days=i))
+                                                            .strftime("%m/%d/%Y")) for i in range(180)]
+        table = farms.precompute_diversion_table('03/25/2013', 180)
+        nose.tools.assert_equals(table.shape, (6, 180))
+        nose.tools.assert_equals(farms.farm_diversion_table.shape, (3, 180))
+        for i in [0, 20, 75, 120, 179]:
+            Dtot, D = farms.retrieve_water_diversion_per_day(i)
+            np.testing.assert_allclose(Dtot, expected[i][0])
+            np.testing.assert_allclose(D.toarray(), expected[i][1].toarray())
+        np.testing.assert_allclose(farms.retrieve_water_diversion_per_node('06/01/2013')[0], expected[68][0])
+        nose.tools.assert_raises(ValueError, farms.retrieve_water_diversion_per_day, -1)
+        nose.tools.assert_raises(ValueError, farms.retrieve_water_diversion_per_day, 180)
+
+    def test_active_cells(self):
+
+        mask = np.ones((30, 40), dtype=bool)
+        mask[:, 36:] = False
+        mask[27:] = False
+        farms = build_farm_coupling(active_cells=utilsRaster.ActiveCells(mask))
+        Dtot, D = farms.retrieve_water_diversion_per_node('06/01/2013')
+        res = farms.retrieve_supplemental_irrigation_map(TestFarmCoupling.land_use, [1, 2], D)
+        np.testing.assert_array_equal(res, TestFarmCoupling.farms.retrieve_supplemental_irrigation_map(
+            TestFarmCoupling.land_use, [1, 2], D))
+
+
+class TestWaterUserIncidence(object):
+
+    def test_incidence(self):
+
+        incidence = coupling.WaterUserIncidence([7, 3, 9, 4], [9, 3, 11, 9, 7])
+        # the user diverting from node 11, which is not in the network, is not coupled
+        np.testing.assert_array_equal(incidence.node_rows, [0, 1, 2, 2])
+        np.testing.assert_array_equal(incidence.user_index, [4, 1, 0, 3])
+        np.testing.assert_array_equal(incidence.node_sum(np.array([1., 2., 3., 4.])), [1., 2., 7., 0.])
+        np.testing.assert_array_equal(incidence.node_user_matrix(np.array([1., 2., 3., 4.])).toarray(),
+                                      [[0, 0, 0, 0, 1], [0, 2, 0, 0, 0], [3, 0, 0, 4, 0], [0, 0, 0, 0, 0]])
+
+
+class TestFarmRegistry(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        rs = np.random.RandomState(4)
+        # farms with different number of crops
+        cls.farms = [SimulatedFarm(source_id, n, rs) for source_id, n in [(3, 1), (1, 3), (3, 2), (4, 4)]]
+        cls.registry = coupling.FarmRegistry(cls.farms, [2, 0, 2, 3], [1, 0, 3, 2], 5, 4)
+
+    def test_flat_arrays(self):
+
+        registry = TestFarmRegistry.registry
+        nose.tools.assert_equals(registry.watersim.size, 10)
+        np.testing.assert_array_equal(registry.farm_of_crop, [0, 1, 1, 1, 2, 2, 3, 3, 3, 3])
+        np.testing.assert_array_equal(registry.node_of_crop, [2, 0, 0, 0, 2, 2, 3, 3, 3, 3])
+        for farm, values in zip(TestFarmRegistry.farms, registry.split_by_farm(registry.watersim)):
+            np.testing.assert_array_equal(values, farm.watersim)
+
+    def test_diversions(self):
+
+        registry = TestFarmRegistry.registry
+        d = registry.crop_diversions(parser.parse('06/15/2013').toordinal())
+        expected = []
+        for farm in TestFarmRegistry.farms:
+            for s, c, e, cid, eff, irr, w in zip(farm.crop_start_date, farm.crop_cover_date, farm.crop_end_date,
+                                                 farm.crop_id, farm.irr_eff, farm.irr, farm.watersim):
+                days = range(parser.parse(s).toordinal(), parser.parse(e).toordinal() + 1)
+                f = sum(retrieve_crop_coefficient(datetime.date.fromordinal(x).strftime("%m/%d/%Y"), s, c, e, cid)
+                        for x in days) * eff * irr
+                expected.append(w * retrieve_crop_coefficient('06/15/2013', s, c, e, cid) / f)
+        np.testing.assert_allclose(d, expected)
+
+        np.testing.assert_allclose(registry.sum_by_node(d), [d[1:4].sum(), 0, d[0] + d[4:6].sum(), d[6:].sum(), 0])
+        np.testing.assert_allclose(registry.sum_by_user(d), [d[1:4].sum(), d[0], d[6:].sum(), d[4:6].sum()])
+        np.testing.assert_allclose(registry.sum_by_farm(d), [d[0], d[1:4].sum(), d[4:6].sum(), d[6:].sum()])
+
+
+class TestScenarioBatch(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.seeds = [3, 4, 5]
+        cls.batch = build_farm_coupling(seeds=cls.seeds)
+        cls.single = [build_farm_coupling(seed=seed) for seed in cls.seeds]
+        cls.land_use = np.random.RandomState(1).randint(0, 4, cls.batch.water_user_mask.shape)
+
+    def test_stack(self):
+
+        registry = TestScenarioBatch.batch.registry
+        nose.tools.assert_equals(registry.n_scenarios, 3)
+        nose.tools.assert_equals(registry.watersim.shape, (3, 9))
+        np.testing.assert_array_equal(registry.farm_of_crop, np.repeat([0, 1, 2], 3))
+
+        other = coupling.FarmRegistry([SimulatedFarm(2, 2, np.random.RandomState(0))], [1], [0], 6, 1)
+        nose.tools.assert_raises(ValueError, coupling.FarmRegistry.stack, [registry, other])
+
+    def test_diversions_per_node(self):
+
+        Dtot, D = TestScenarioBatch.batch.retrieve_water_diversion_per_node('06/01/2013')
+        nose.tools.assert_equals(Dtot.shape, (3, 2, 6))
+        for s, single in enumerate(TestScenarioBatch.single):
+            Dtot_s, D_s = single.retrieve_water_diversion_per_node('06/01/2013')
+            np.testing.assert_allclose(Dtot[s], Dtot_s)
+            np.testing.assert_allclose(D[s].toarray(), D_s.toarray())
+
+    def test_season_table(self):
+
+        batch = build_farm_coupling(seeds=TestScenarioBatch.seeds)
+        table = batch.precompute_diversion_table('04/01/2013', 30)
+        nose.tools.assert_equals(table.shape, (3, 6, 30))
+        Dtot, D = batch.retrieve_water_diversion_per_node('04/20/2013')
+        for s, single in enumerate(TestScenarioBatch.single):
+            Dtot_s, D_s = single.retrieve_water_diversion_per_node('04/20/2013')
+            np.testing.assert_allclose(Dtot[s], Dtot_s)
+            np.testing.assert_allclose(D[s].toarray(), D_s.toarray())
+
+    def test_supplemental_irrigation(self):
+
+        lu = TestScenarioBatch.land_use
+        Dtot, D = TestScenarioBatch.batch.retrieve_water_diversion_per_node('07/01/2013')
+        res = TestScenarioBatch.batch.retrieve_supplemental_irrigation_map(lu, [1, 2], D)
+        nose.tools.assert_equals(res.shape, (3,) + lu.shape)
+        for s, single in enumerate(TestScenarioBatch.single):
+            Dtot_s, D_s = single.retrieve_water_diversion_per_node('07/01/2013')
+            np.testing.assert_allclose(res[s], single.retrieve_supplemental_irrigation_map(lu, [1, 2], D_s))
+
+
+class ScenarioFarm(object):
+    """Farm recording the scenarios it was simulated with"""
+    def __init__(self, source_id):
+        self.source_id = source_id
+        self.simulated = []
+
+    def simulate(self, **obs):
+        self.simulated.append(obs['scenario'])
+
+
+class TestSimulateFarms(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.source_ids = [4, 2, 4, 7, 9]
+        cls.scenarios = [{'farm_id': fid, 'scenario': i} for i, fid in enumerate([2, 4, 5, 2, 7, 4])]
+
+    def test_dispatch(self):
+
+        farms = [ScenarioFarm(s) for s in TestSimulateFarms.source_ids]
+        res = coupling.dispatch_scenarios(farms, TestSimulateFarms.scenarios)
+        nose.tools.assert_equals([[obs['scenario'] for obs in lst] for lst in res], [[1, 5], [0, 3], [1, 5], [4], []])
+
+    def test_process_pool(self):
+
+        serial = coupling.simulate_farms([ScenarioFarm(s) for s in TestSimulateFarms.source_ids],
+                                         TestSimulateFarms.scenarios)
+        pool = multiprocessing.Pool(2)
+        try:
+            parallel = coupling.simulate_farms([ScenarioFarm(s) for s in TestSimulateFarms.source_ids],
+                                               TestSimulateFarms.scenarios, pool)
+        finally:
+            pool.close()
+        nose.tools.assert_equals([f.simulated for f in parallel], [f.simulated for f in serial])
+        nose.tools.assert_equals([f.source_id for f in parallel], TestSimulateFarms.source_ids)
+        nose.tools.assert_equals(serial[4].simulated, [])
+
+
+class Network(object):
+    node_ids = np.arange(1, 7)
+
+
+class TestWaterUserMask(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.outdir = tempfile.mkdtemp()
+        cls.fn = os.path.join(cls.outdir, 'farms.geojson')
+        schema = {'geometry': 'Polygon', 'properties': {'farm_id': 'int'}}
+        with fiona.open(cls.fn, 'w', driver='GeoJSON', schema=schema) as dst:
+            for i, farm_id in enumerate([10, 300, 12]):
+                x0 = 1 + 12 * i
+                dst.write({'geometry': {'type': 'Polygon', 'coordinates': [
+                    [(x0, 2), (x0 + 10, 2), (x0 + 10, 12), (x0, 12), (x0, 2)]]}, 'properties': {'farm_id': farm_id}})
+        cls.precip = np.random.RandomState(0).uniform(0, 5, (20, 40))
+        cls.transform = Affine(1., 0, 0, 0, -1., 20.)
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_integer_mask(self):
+
+        hydro = coupling.HydroEconCoupling(Network(), [], TestWaterUserMask.precip, TestWaterUserMask.transform)
+        mask = hydro.setup_farmer_user(TestWaterUserMask.fn, 'farm_id').water_user_mask
+        nose.tools.assert_equals(mask.dtype, np.uint16)
+        np.testing.assert_array_equal(np.unique(mask), [0, 10, 12, 300])
+        nose.tools.assert_equals(np.count_nonzero(mask == 300), 100)
+        nose.tools.assert_equals(utilsRaster.min_integer_dtype([0, 12]), np.uint8)
+        nose.tools.assert_equals(utilsRaster.min_integer_dtype([-1, 200]), np.int16)
+        nose.tools.assert_equals(utilsRaster.min_integer_dtype([0, 1.5]), np.float64)
+
+    def test_cache(self):
+
+        fn_cache = os.path.join(TestWaterUserMask.outdir, 'mask.npz')
+        hydro = coupling.HydroEconCoupling(Network(), [], TestWaterUserMask.precip, TestWaterUserMask.transform)
+        expected = hydro.setup_farmer_user(TestWaterUserMask.fn, 'farm_id').water_user_mask
+        hydro.setup_farmer_user(TestWaterUserMask.fn, 'farm_id', fn_cache=fn_cache)
+        nose.tools.assert_true(os.path.exists(fn_cache))
+
+        hydro = coupling.HydroEconCoupling(Network(), [], TestWaterUserMask.precip, TestWaterUserMask.transform)
+        cached = hydro.setup_farmer_user(TestWaterUserMask.fn, 'farm_id', fn_cache=fn_cache).water_user_mask
+        np.testing.assert_array_equal(cached, expected)
+        nose.tools.assert_equals(cached.dtype, expected.dtype)
+
+        # a different grid does not use the cached mask
+        shifted = Affine(1., 0, -5., 0, -1., 20.)
+        hydro = coupling.HydroEconCoupling(Network(), [], TestWaterUserMask.precip, shifted)
+        mask = hydro.setup_farmer_user(TestWaterUserMask.fn, 'farm_id', fn_cache=fn_cache).water_user_mask
+        np.testing.assert_array_equal(mask[:, 5:], expected[:, :-5])
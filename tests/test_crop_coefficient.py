@@ -0,0 +1,72 @@
+from utils import crop_coefficient
+import numpy as np
+import datetime
+import nose
+
+
+class TestCropCoefficientTable(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.table = crop_coefficient.get_crop_coefficient_table()
+        cls.start = datetime.date(2013, 4, 1)
+
+    def date(self, day):
+        return (TestCropCoefficientTable.start + datetime.timedelta(days=int(day))).strftime("%m/%d/%Y")
+
+    def test_knots(self):
+
+        table = TestCropCoefficientTable.table
+        row = table.crop_index(4)
+        # 10 days per knot before full cover and 5 days per knot after it
+        days = np.arange(1, 151)
+        kcs = table.coefficients(days, 0, 100, 150, 4)
+        np.testing.assert_allclose(kcs[9:100:10], table.curves[row, 1:11])
+        np.testing.assert_allclose(kcs[104::5], table.curves[row, 11:])
+        np.testing.assert_allclose(kcs[4], (table.curves[row, 0] + table.curves[row, 1]) / 2)
+
+    def test_outside_season(self):
+
+        table = TestCropCoefficientTable.table
+        np.testing.assert_array_equal(table.coefficients([-5, 0, 151, 300], 0, 100, 150, 4), 0)
+
+    def test_batch_matches_dates(self):
+
+        table = TestCropCoefficientTable.table
+        crops = np.array([1, 4, 23, 4])[:, None]
+        start, cover, end = np.array([[0], [10], [20], [35]]), np.array([[40], [50], [80], [60]]), \
+            np.array([[90], [120], [100], [61]])
+        days = np.arange(0, 125, 7)
+        kcs = table.coefficients(days, start, cover, end, crops)
+        nose.tools.assert_equals(kcs.shape, (4, days.size))
+        for i in range(4):
+            for j, d in enumerate(days):
+                kc = crop_coefficient.retrieve_crop_coefficient(
+                    self.date(d), self.date(start[i, 0]), self.date(cover[i, 0]), self.date(end[i, 0]), crops[i, 0])
+                nose.tools.assert_almost_equals(kcs[i, j], kc)
+
+    def test_unknown_crop(self):
+
+        nose.tools.assert_raises(KeyError, TestCropCoefficientTable.table.crop_index, [1, 9999])
+
+    def test_table_parsed_once(self):
+
+        nose.tools.assert_is(crop_coefficient.get_crop_coefficient_table(), TestCropCoefficientTable.table)
+
+    def test_seasonal_sum(self):
+
+        table = TestCropCoefficientTable.table
+        rs = np.random.RandomState(1)
+        start = rs.randint(0, 100, 200)
+        cover = start + rs.randint(-5, 90, 200)
+        end = cover + rs.randint(0, 120, 200)
+        crops = rs.choice(table.crop_ids, 200)
+        first, last = start + rs.randint(-10, 40, 200), end + rs.randint(-40, 10, 200)
+
+        res = crop_coefficient.seasonal_crop_coefficient_sum(start, cover, end, crops)
+        windowed = table.seasonal_sum(start, cover, end, crops, first, last)
+        for i in range(200):
+            kcs = table.coefficients(np.arange(start[i], end[i] + 1), start[i], cover[i], end[i], crops[i])
+            nose.tools.assert_almost_equals(res[i], kcs.sum())
+            kcs = table.coefficients(np.arange(first[i], last[i] + 1), start[i], cover[i], end[i], crops[i])
+            nose.tools.assert_almost_equals(windowed[i], kcs.sum())
@@ -0,0 +1,49 @@
+from utils import utilsRaster
+from utils import hbv
+import numpy as np
+import nose
+
+
+class TestHBVSnowSoil(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        names = ["pp_temp_thres", "ddf", "soil_max_wat", "soil_beta", "aet_lp_param"]
+        fns = ["../params/%s.tif" % name for name in names]
+        cls.dataset = utilsRaster.ModelRasterDatasetHBV(fns[0], *fns)
+        cls.shape = cls.dataset.base_map.shape
+
+        np.random.seed(3)
+        days = 30
+        cls.precip = np.random.exponential(3., (days,) + cls.shape)
+        cls.temp = np.random.uniform(-10., 15., (days,) + cls.shape)
+        cls.pet = np.random.uniform(0., 4., (days,) + cls.shape)
+
+    def test_run_matches_steps(self):
+
+        block = hbv.HBVSnowSoil.from_raster_dataset(TestHBVSnowSoil.dataset)
+        daily = hbv.HBVSnowSoil.from_raster_dataset(TestHBVSnowSoil.dataset)
+        res = block.run(TestHBVSnowSoil.precip, TestHBVSnowSoil.temp, TestHBVSnowSoil.pet)
+        for t in range(TestHBVSnowSoil.precip.shape[0]):
+            step = daily.step(TestHBVSnowSoil.precip[t], TestHBVSnowSoil.temp[t], TestHBVSnowSoil.pet[t])
+            for a, b in zip(res, step):
+                np.testing.assert_allclose(a[t], b)
+
+    def test_water_balance(self):
+
+        kernel = hbv.HBVSnowSoil.from_raster_dataset(TestHBVSnowSoil.dataset, soil_wat=10.)
+        recharge, aet, swe, soil = kernel.run(TestHBVSnowSoil.precip, TestHBVSnowSoil.temp, TestHBVSnowSoil.pet)
+        balance = TestHBVSnowSoil.precip.sum(axis=0) - recharge.sum(axis=0) - aet.sum(axis=0) - swe[-1] - (soil[-1] - 10.)
+        np.testing.assert_allclose(balance, 0., atol=1e-9)
+        nose.tools.assert_true(np.all(soil <= 50.))
+        nose.tools.assert_true(np.all(swe >= 0.))
+
+    def test_inactive_cells(self):
+
+        mask = np.zeros(TestHBVSnowSoil.shape, dtype=bool)
+        mask[10:20, 30:40] = True
+        kernel = hbv.HBVSnowSoil.from_raster_dataset(TestHBVSnowSoil.dataset, mask=mask)
+        nose.tools.assert_equals(kernel.swe.size, 100)
+        recharge = kernel.step(TestHBVSnowSoil.precip[0], TestHBVSnowSoil.temp[0], TestHBVSnowSoil.pet[0])[0]
+        nose.tools.assert_true(np.all(np.isnan(recharge[~mask])))
+        nose.tools.assert_true(np.all(np.isfinite(recharge[mask])))
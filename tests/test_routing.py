@@ -0,0 +1,74 @@
+from utils import utilsVector
+from utils import routing
+import numpy as np
+import nose
+
+
+class TestMuskingumCungeRouting(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.network = utilsVector.ParseNetwork("../params/rivout.shp")
+        cls.n = cls.network.node_ids.size
+
+    def reach_by_reach(self, laterals, e, ks, dt):
+        """Routes reach by reach walking the dense connectivity matrix in topological order"""
+        conn = TestMuskingumCungeRouting.network.conn_matrix.values
+        c0, c1, c2 = routing.MuskingumCungeRouting.routing_coefficients(e, ks, dt)
+        q = np.zeros(TestMuskingumCungeRouting.n)
+        i_prev = np.zeros(TestMuskingumCungeRouting.n)
+        out = []
+        for lateral in laterals:
+            q_new = np.zeros_like(q)
+            i_new = np.zeros_like(q)
+            for v in TestMuskingumCungeRouting.network.topo_order:
+                i_new[v] = lateral[v] + sum(q_new[u] for u in np.flatnonzero(conn[:, v]))
+                q_new[v] = c0[v] * i_new[v] + c1[v] * i_prev[v] + c2[v] * q[v]
+            q, i_prev = q_new, i_new
+            out.append(q.copy())
+        return np.array(out)
+
+    def test_route_matches_reach_by_reach(self):
+
+        np.random.seed(1)
+        laterals = np.random.uniform(0, 10, (20, TestMuskingumCungeRouting.n))
+        model = routing.MuskingumCungeRouting(TestMuskingumCungeRouting.network)
+        expected = self.reach_by_reach(laterals, model.e, model.ks, model.dt)
+        np.testing.assert_allclose(model.route(laterals), expected)
+
+    def test_ensemble_members(self):
+
+        np.random.seed(2)
+        laterals = np.random.uniform(0, 10, (10, TestMuskingumCungeRouting.n, 3))
+        e = np.random.uniform(0, 0.5, TestMuskingumCungeRouting.n)
+        model = routing.MuskingumCungeRouting(TestMuskingumCungeRouting.network, e=e, ks=50000.)
+        res = model.route(laterals)
+        for m in range(3):
+            single = routing.MuskingumCungeRouting(TestMuskingumCungeRouting.network, e=e, ks=50000.)
+            np.testing.assert_allclose(res[:, :, m], single.route(laterals[:, :, m]))
+
+    def test_vector_to_ensemble_step(self):
+
+        np.random.seed(3)
+        n = TestMuskingumCungeRouting.n
+        warmup = np.random.uniform(0, 10, (5, n))
+        laterals = np.random.uniform(0, 10, (4, n, 3))
+        model = routing.MuskingumCungeRouting(TestMuskingumCungeRouting.network)
+        model.route(warmup)
+        res = [model.step(lateral) for lateral in laterals]
+        for m in range(3):
+            single = routing.MuskingumCungeRouting(TestMuskingumCungeRouting.network)
+            single.route(warmup)
+            expected = single.route(laterals[:, :, m])
+            np.testing.assert_allclose(np.array(res)[:, :, m], expected)
+
+        nose.tools.assert_raises(ValueError, model.step, warmup[0])
+
+    def test_steady_state_mass_balance(self):
+
+        net = TestMuskingumCungeRouting.network
+        model = routing.MuskingumCungeRouting(net)
+        lateral = np.ones(TestMuskingumCungeRouting.n)
+        out = model.route(np.tile(lateral, (200, 1)))
+        outlets = np.diff(net.conn_sparse.indptr) == 0
+        np.testing.assert_allclose(out[-1][outlets].sum(), lateral.sum())
@@ -0,0 +1,100 @@
+from utils import utilsCalendar
+from utils.utilsOutputs import WriteOutputTimeSeries
+from dateutil import parser
+import datetime
+import numpy as np
+import pandas as pd
+import tempfile
+import shutil
+import os
+import nose
+
+
+class TestConversions(object):
+
+    def test_to_ordinal(self):
+
+        expected = datetime.date(2013, 6, 3).toordinal()
+        for date in ['06/03/2013', '2013-06-03', datetime.date(2013, 6, 3), datetime.datetime(2013, 6, 3, 12),
+                     np.datetime64('2013-06-03'), expected]:
+            nose.tools.assert_equals(utilsCalendar.to_ordinal(date), expected)
+        # repeated strings are served from the parsed dates
+        nose.tools.assert_equals(utilsCalendar.to_ordinal('06/03/2013'), expected)
+        nose.tools.assert_raises(TypeError, utilsCalendar.to_ordinal, 3.5)
+
+    def test_to_ordinals(self):
+
+        dates = ['4/1/2013', '6/10/2013', '4/1/2013', '8/20/2013']
+        expected = [parser.parse(d).toordinal() for d in dates]
+        np.testing.assert_array_equal(utilsCalendar.to_ordinals(dates), expected)
+        np.testing.assert_array_equal(utilsCalendar.to_ordinals(utilsCalendar.ordinals_to_datetime64(expected)),
+                                      expected)
+
+    def test_datetime64(self):
+
+        days = np.arange(734000, 734800, 7)
+        dates = utilsCalendar.ordinals_to_datetime64(days)
+        nose.tools.assert_equals(dates.dtype, np.dtype('datetime64[D]'))
+        nose.tools.assert_equals(str(dates[0]), datetime.date.fromordinal(734000).isoformat())
+        np.testing.assert_array_equal(utilsCalendar.datetime64_to_ordinals(dates), days)
+
+    def test_format_days(self):
+
+        days = np.arange(735000, 735100)
+        for fmt in ["%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y"]:
+            nose.tools.assert_equals(utilsCalendar.format_days(days, fmt),
+                                     [datetime.date.fromordinal(d).strftime(fmt) for d in days])
+
+
+class TestSimulationCalendar(object):
+
+    def test_steps(self):
+
+        calendar = utilsCalendar.SimulationCalendar('10/01/2009', dt=2)
+        start = datetime.date(2009, 10, 1)
+        np.testing.assert_array_equal(calendar.ordinals(4), [start.toordinal() + 2 * i for i in range(4)])
+        nose.tools.assert_equals(calendar.labels(2, "%m/%d/%Y"), ['10/01/2009', '10/03/2009'])
+        nose.tools.assert_equals(calendar.step('10/06/2009'), 2)
+
+    def test_time_of_day(self):
+
+        start = datetime.datetime(2012, 1, 1, 18)
+        for dt in [0.5, 0.25, 1. / 3, 1.7]:
+            calendar = utilsCalendar.SimulationCalendar('2012-01-01 18:00', dt=dt)
+            nose.tools.assert_equals(calendar.labels(20, "%m/%d"),
+                                     [(start + ts * datetime.timedelta(days=dt)).strftime("%m/%d") for ts in range(20)])
+        calendar = utilsCalendar.SimulationCalendar(np.datetime64('2012-01-01T18:00'), dt=0.5)
+        nose.tools.assert_equals(calendar.labels(2, "%m/%d"), ['01/01', '01/02'])
+        nose.tools.assert_equals(calendar.step(datetime.datetime(2012, 1, 2, 17)), 1)
+
+
+class TestWriteJson(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.cwd = os.getcwd()
+        cls.tmpdir = tempfile.mkdtemp()
+        os.chdir(cls.tmpdir)
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.tmpdir)
+
+    def test_dates(self):
+
+        conn = pd.DataFrame(0, index=[3, 7], columns=[3, 7])
+        data = [np.array([1., 2.]), np.array([3., 4.]), np.array([5., 6.])]
+        res = WriteOutputTimeSeries(conn, '12/30/2012').write_json(data)
+        dates = ['2012/12/30', '2012/12/31', '2013/01/01']
+        nose.tools.assert_equals([n['id'] for n in res['nodes']], [3, 7])
+        for row, node in enumerate(res['nodes']):
+            nose.tools.assert_equals([d['date'] for d in node['dates']], dates)
+            nose.tools.assert_equals([d['flow'] for d in node['dates']], [x[row] for x in data])
+
+    def test_fractional_time_step(self):
+
+        conn = pd.DataFrame(0, index=[3], columns=[3])
+        res = WriteOutputTimeSeries(conn, '2012-01-01 18:00', dt=0.5).write_json([np.ones(1), np.ones(1)])
+        nose.tools.assert_equals([d['date'] for d in res['nodes'][0]['dates']], ['2012/01/01', '2012/01/02'])
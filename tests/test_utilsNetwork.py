@@ -0,0 +1,106 @@
+from utils import utilsVector
+from utils import utilsNetwork
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import nose
+
+
+class TestNetworkReachability(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.network = utilsVector.ParseNetwork("../params/rivout.shp")
+        cls.index = utilsNetwork.NetworkReachability(cls.network)
+
+        # brute force upstream sets walking the dense connectivity matrix
+        conn = cls.network.conn_matrix
+        cls.upstream_sets = {}
+        for node in conn.index:
+            found = set([node])
+            frontier = [node]
+            while frontier:
+                frontier = [u for v in frontier for u in conn.index[conn[v].values == 1]]
+                found.update(frontier)
+            cls.upstream_sets[node] = found
+
+    def test_upstream(self):
+
+        for node, expected in TestNetworkReachability.upstream_sets.items():
+            nose.tools.assert_equals(set(TestNetworkReachability.index.upstream(node)), expected)
+            nose.tools.assert_not_in(node, TestNetworkReachability.index.upstream(node, include_self=False))
+
+    def test_downstream_path(self):
+
+        conn = TestNetworkReachability.network.conn_matrix
+        for node in conn.index:
+            path = TestNetworkReachability.index.downstream_path(node)
+            nose.tools.assert_equals(path[0], node)
+            for a, b in zip(path[:-1], path[1:]):
+                nose.tools.assert_equals(conn.loc[a, b], 1)
+            nose.tools.assert_equals(conn.loc[path[-1]].sum(), 0)
+
+    def test_is_upstream(self):
+
+        nodes = TestNetworkReachability.network.node_ids
+        u, v = np.meshgrid(nodes, nodes, indexing='ij')
+        res = TestNetworkReachability.index.is_upstream(u, v)
+        expected = np.array([[a in TestNetworkReachability.upstream_sets[b] for b in nodes] for a in nodes])
+        np.testing.assert_array_equal(res, expected)
+
+    def test_accumulate(self):
+
+        net = TestNetworkReachability.network
+        area = np.zeros(net.node_ids.size)
+        area[net.reach_rows] = net.get_parameters(['AreaC'])[0]
+        acc = TestNetworkReachability.index.accumulate(area)
+        for row, node in enumerate(net.node_ids):
+            rows = net.get_node_index(list(TestNetworkReachability.upstream_sets[node]))
+            np.testing.assert_allclose(acc[row], area[rows].sum())
+
+
+def count_upstream_nodes(rows, upstream_results):
+    """Number of nodes draining to the outlet of a partition"""
+    return rows.size + sum(upstream_results)
+
+
+class TestNetworkScheduler(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.network = utilsVector.ParseNetwork("../params/rivout.shp")
+        cls.index = utilsNetwork.NetworkReachability(cls.network)
+
+    def test_levels(self):
+
+        scheduler = utilsNetwork.NetworkScheduler(TestNetworkScheduler.network)
+        rows, cols = TestNetworkScheduler.network.conn_sparse.nonzero()
+        nose.tools.assert_true(np.all(scheduler.level_of[rows] < scheduler.level_of[cols]))
+        nose.tools.assert_equals(sum(l.size for l in scheduler.levels), scheduler.node_ids.size)
+
+    def test_partitions(self):
+
+        for size in [None, 1, 10, 50]:
+            scheduler = utilsNetwork.NetworkScheduler(TestNetworkScheduler.network, max_partition_size=size)
+            rows = np.concatenate(scheduler.partitions)
+            nose.tools.assert_equals(sorted(rows), list(range(scheduler.node_ids.size)))
+            for p, part in enumerate(scheduler.partitions):
+                # every partition is a connected sub-tree draining to its outlet
+                outlet = scheduler.partition_outlets[p]
+                nose.tools.assert_equals(part[-1], outlet)
+                nose.tools.assert_true(np.all(TestNetworkScheduler.index.is_upstream(
+                    scheduler.node_ids[part], scheduler.node_ids[outlet])))
+
+    def test_run_partitions(self):
+
+        index = TestNetworkScheduler.index
+        for size in [None, 5, 40]:
+            scheduler = utilsNetwork.NetworkScheduler(TestNetworkScheduler.network, max_partition_size=size)
+            serial = scheduler.run_partitions(count_upstream_nodes)
+            pool = ThreadPool(4)
+            try:
+                parallel = scheduler.run_partitions(count_upstream_nodes, pool)
+            finally:
+                pool.close()
+            nose.tools.assert_equals(serial, parallel)
+            outlets = scheduler.partition_outlets
+            nose.tools.assert_equals(serial, list(index.tout[outlets] - index.tin[outlets]))
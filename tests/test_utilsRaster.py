@@ -0,0 +1,279 @@
+from utils import utilsRaster
+import numpy as np
+import rasterio as rio
+import tempfile
+import shutil
+import os
+import nose
+
+
+class TestReadRaster(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.fn = "../params/soil_max_wat.tif"
+        with rio.open(cls.fn) as src:
+            cls.values = src.read()
+            cls.profile = src.profile
+        cls.outdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_lazy_array(self):
+
+        raster = utilsRaster.RasterParameterIO(TestReadRaster.fn)
+        nose.tools.assert_is_none(raster._array)
+        nose.tools.assert_equals(raster.shape, TestReadRaster.values.shape[1:])
+        np.testing.assert_array_equal(raster.array, TestReadRaster.values)
+
+    def test_read_window_and_blocks(self):
+
+        raster = utilsRaster.RasterParameterIO(TestReadRaster.fn, 1)
+        np.testing.assert_array_equal(raster.read_window(((5, 15), (20, 60))), TestReadRaster.values[0, 5:15, 20:60])
+
+        mosaic = np.zeros(raster.shape)
+        for window, block in raster.iter_blocks():
+            mosaic[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width] = block
+        np.testing.assert_array_equal(mosaic, TestReadRaster.values[0])
+
+    def test_memmap(self):
+
+        fn = os.path.join(TestReadRaster.outdir, "stack.tif")
+        profile = TestReadRaster.profile.copy()
+        profile.update(count=2, dtype='int16')
+        stack = np.arange(2 * TestReadRaster.values[0].size, dtype='int16').reshape((2,) + TestReadRaster.values.shape[1:])
+        with rio.open(fn, 'w', **profile) as dst:
+            dst.write(stack)
+
+        raster = utilsRaster.RasterParameterIO(fn, mmap=True)
+        nose.tools.assert_true(isinstance(raster.array, np.memmap))
+        np.testing.assert_array_equal(raster.array, stack)
+        np.testing.assert_array_equal(raster.read_memmap(2), stack[1])
+
+    def test_memmap_fallback(self):
+
+        fn = os.path.join(TestReadRaster.outdir, "compressed.tif")
+        profile = TestReadRaster.profile.copy()
+        profile.update(compress='deflate')
+        with rio.open(fn, 'w', **profile) as dst:
+            dst.write(TestReadRaster.values)
+
+        raster = utilsRaster.RasterParameterIO(fn, mmap=True)
+        nose.tools.assert_raises(ValueError, raster.read_memmap)
+        nose.tools.assert_false(isinstance(raster.array, np.memmap))
+        np.testing.assert_array_equal(raster.array, TestReadRaster.values)
+
+
+class TestHBVParameterCube(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.names = ["pp_temp_thres", "ddf", "soil_max_wat", "soil_beta", "aet_lp_param"]
+        cls.fns = ["../params/%s.tif" % name for name in cls.names]
+        cls.dataset = utilsRaster.ModelRasterDatasetHBV(cls.fns[0], *cls.fns)
+        cls.outdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_named_access(self):
+
+        cube = utilsRaster.HBVParameterCube(TestHBVParameterCube.dataset)
+        nose.tools.assert_equals(cube.names, TestHBVParameterCube.names)
+        nose.tools.assert_equals(cube.array.shape, (5,) + TestHBVParameterCube.dataset.base_map.shape)
+        nose.tools.assert_true(cube.array.flags['C_CONTIGUOUS'])
+        for name, fn in zip(TestHBVParameterCube.names, TestHBVParameterCube.fns):
+            np.testing.assert_array_equal(cube[name], utilsRaster.RasterParameterIO(fn, 1).array)
+        nose.tools.assert_raises(KeyError, cube.__getitem__, 'not_a_parameter')
+
+    def test_cache(self):
+
+        fn_cache = os.path.join(TestHBVParameterCube.outdir, "cube.npz")
+        cube = utilsRaster.HBVParameterCube(TestHBVParameterCube.dataset, dtype='float32', fn_cache=fn_cache)
+        nose.tools.assert_true(os.path.exists(fn_cache))
+        cached = utilsRaster.HBVParameterCube(TestHBVParameterCube.dataset, dtype='float32', fn_cache=fn_cache)
+        nose.tools.assert_equals(cached.array.dtype, np.float32)
+        np.testing.assert_array_equal(cached.array, cube.array)
+
+    def test_misaligned_map(self):
+
+        fn = os.path.join(TestHBVParameterCube.outdir, "small.tif")
+        with rio.open(TestHBVParameterCube.fns[1]) as src:
+            profile = src.profile
+            profile.update(width=10, height=10)
+            with rio.open(fn, 'w', **profile) as dst:
+                dst.write(src.read(window=((0, 10), (0, 10))))
+
+        dataset = utilsRaster.ModelRasterDatasetHBV(TestHBVParameterCube.fns[0], fn_ddf=fn)
+        nose.tools.assert_raises(ValueError, utilsRaster.HBVParameterCube, dataset)
+
+
+class TestWriteGeotiff(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.raster = utilsRaster.RasterParameterIO("../params/ddf.tif", 1)
+        cls.outdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_default_float64(self):
+
+        fn = os.path.join(TestWriteGeotiff.outdir, "default.tif")
+        arr = np.ones(TestWriteGeotiff.raster.shape, dtype='int16')
+        TestWriteGeotiff.raster.write_array_to_geotiff(fn, arr)
+        with rio.open(fn) as src:
+            nose.tools.assert_equals(src.dtypes, ('float64',))
+            np.testing.assert_array_equal(src.read(1), arr)
+
+    def test_compressed_tiled_stack(self):
+
+        fn = os.path.join(TestWriteGeotiff.outdir, "stack.tif")
+        shape = TestWriteGeotiff.raster.shape
+        stack = np.random.uniform(size=(3,) + shape).astype('float32')
+        TestWriteGeotiff.raster.write_array_to_geotiff(fn, stack, dtype=None, compress='deflate', tiled=True,
+                                                       blocksize=64, overviews=[2, 4])
+        with rio.open(fn) as src:
+            nose.tools.assert_equals(src.count, 3)
+            nose.tools.assert_equals(src.dtypes, ('float32',) * 3)
+            nose.tools.assert_equals(src.compression.value, 'DEFLATE')
+            nose.tools.assert_equals(src.block_shapes[0], (64, 64))
+            nose.tools.assert_equals(src.overviews(1), [2, 4])
+            np.testing.assert_array_equal(src.read(), stack)
+
+    def test_shape_mismatch(self):
+
+        fn = os.path.join(TestWriteGeotiff.outdir, "bad.tif")
+        nose.tools.assert_raises(ValueError, TestWriteGeotiff.raster.write_array_to_geotiff, fn, np.zeros((3, 3)))
+
+
+class TestRasterCache(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.outdir = tempfile.mkdtemp()
+        with rio.open("../params/ddf.tif") as src:
+            cls.profile = src.profile
+            cls.values = src.read(1)
+        cls.fns = []
+        for i in range(3):
+            fn = os.path.join(cls.outdir, "map%i.tif" % i)
+            with rio.open(fn, 'w', **cls.profile) as dst:
+                dst.write(cls.values + i, 1)
+            cls.fns.append(fn)
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_read_only_hits(self):
+
+        cache = utilsRaster.RasterCache()
+        first = cache.get(TestRasterCache.fns[0], 1)
+        nose.tools.assert_true(cache.get(TestRasterCache.fns[0], 1) is first)
+        nose.tools.assert_false(first.flags.writeable)
+        np.testing.assert_array_equal(first, TestRasterCache.values)
+        nose.tools.assert_equals(cache.get(TestRasterCache.fns[0]).shape, (1,) + TestRasterCache.values.shape)
+
+    def test_lru_eviction(self):
+
+        cache = utilsRaster.RasterCache(max_bytes=2 * TestRasterCache.values.nbytes)
+        a = cache.get(TestRasterCache.fns[0], 1)
+        cache.get(TestRasterCache.fns[1], 1)
+        cache.get(TestRasterCache.fns[0], 1)
+        cache.get(TestRasterCache.fns[2], 1)
+        nose.tools.assert_equals(cache.nbytes, 2 * TestRasterCache.values.nbytes)
+        nose.tools.assert_true(cache.get(TestRasterCache.fns[0], 1) is a)
+        nose.tools.assert_equals(len(cache._entries), 2)
+        cache.resize(0)
+        nose.tools.assert_equals(cache.nbytes, 0)
+
+    def test_modified_file(self):
+
+        cache = utilsRaster.RasterCache()
+        fn = TestRasterCache.fns[2]
+        cache.get(fn, 1)
+        with rio.open(fn, 'w', **TestRasterCache.profile) as dst:
+            dst.write(TestRasterCache.values * 0, 1)
+        st = os.stat(fn)
+        os.utime(fn, (st.st_atime, st.st_mtime + 10))
+        np.testing.assert_array_equal(cache.get(fn, 1), 0)
+        nose.tools.assert_equals(len(cache._entries), 1)
+
+    def test_raster_parameter_io(self):
+
+        raster = utilsRaster.RasterParameterIO(TestRasterCache.fns[1], 1, use_cache=True)
+        nose.tools.assert_true(raster.array is utilsRaster.raster_cache.get(TestRasterCache.fns[1], 1))
+
+    def test_cube_reuses_cached_maps(self):
+
+        dataset = TestHBVParameterCube.dataset
+        utilsRaster.HBVParameterCube(dataset)
+        opened = []
+        rio_open = utilsRaster.rio.open
+
+        def counting_open(fn, *args, **kwargs):
+            opened.append(fn)
+            return rio_open(fn, *args, **kwargs)
+
+        utilsRaster.rio.open = counting_open
+        try:
+            cube = utilsRaster.HBVParameterCube(dataset)
+        finally:
+            utilsRaster.rio.open = rio_open
+        nose.tools.assert_equals(opened, [])
+        meta = utilsRaster.raster_cache.metadata(TestHBVParameterCube.fns[1])
+        nose.tools.assert_equals(meta['shape'], cube.shape)
+        nose.tools.assert_true(meta['transform'].almost_equals(cube.transform))
+
+
+
+class TestActiveCells(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.raster = utilsRaster.RasterParameterIO("../params/soil_max_wat.tif", 1)
+        cls.values = cls.raster.array.copy()
+        # an irregular basin inside the bounding box of the raster
+        rows, cols = np.indices(cls.values.shape)
+        cls.mask = (rows - cls.values.shape[0] / 2.) ** 2 + (cols - cls.values.shape[1] / 3.) ** 2 < 400
+        cls.cells = utilsRaster.ActiveCells(cls.mask)
+
+    def test_round_trip(self):
+
+        cells = TestActiveCells.cells
+        compressed = cells.compress(TestActiveCells.values)
+        nose.tools.assert_equals(compressed.shape, (np.count_nonzero(TestActiveCells.mask),))
+        np.testing.assert_array_equal(compressed, TestActiveCells.values[TestActiveCells.mask])
+        np.testing.assert_array_equal(TestActiveCells.values[cells.rows, cells.cols], compressed)
+
+        expanded = cells.expand(compressed, fill_value=-9999)
+        np.testing.assert_array_equal(expanded, np.where(TestActiveCells.mask, TestActiveCells.values, -9999))
+
+    def test_leading_axes(self):
+
+        cells = TestActiveCells.cells
+        block = np.stack([TestActiveCells.values * k for k in range(3)])
+        compressed = cells.compress(block)
+        nose.tools.assert_equals(compressed.shape, (3, cells.size))
+        np.testing.assert_array_equal(cells.expand(compressed)[:, TestActiveCells.mask], block[:, TestActiveCells.mask])
+        nose.tools.assert_raises(ValueError, cells.compress, block[:, 1:])
+
+    def test_from_raster(self):
+
+        raster = utilsRaster.RasterParameterIO("../params/soil_max_wat.tif", 1)
+        raster.array = np.where(TestActiveCells.mask, TestActiveCells.values, raster.nodata)
+        cells = raster.get_active_cells()
+        np.testing.assert_array_equal(cells.mask, TestActiveCells.mask)
+        np.testing.assert_array_equal(raster.compress(cells), TestActiveCells.values[TestActiveCells.mask])
+        nose.tools.assert_equals(utilsRaster.ActiveCells.from_raster("../params/soil_max_wat.tif").size,
+                                 TestActiveCells.values.size)
@@ -0,0 +1,251 @@
+from utils import utilsVector
+import numpy as np
+import pandas as pd
+import tempfile
+import shutil
+import os
+import nose
+
+
+class TestParseNetwork(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.fn = "../params/rivout.shp"
+        cls.network = utilsVector.ParseNetwork(cls.fn)
+
+    def test_sparse_matches_dense(self):
+
+        dense = TestParseNetwork.network.conn_matrix
+        nose.tools.assert_equals(list(dense.index), list(TestParseNetwork.network.node_ids))
+        np.testing.assert_array_equal(dense.values, TestParseNetwork.network.conn_sparse.toarray())
+
+    def test_links_from_vector_file(self):
+
+        net = TestParseNetwork.network
+        from_nodes = net.get_parameter("FROM_NODE")
+        to_nodes = net.get_parameter("TO_NODE")
+        nose.tools.assert_equals(net.conn_sparse.nnz, sum(1 for t in to_nodes if t > 0))
+        for f, t in zip(from_nodes, to_nodes):
+            if t > 0:
+                nose.tools.assert_equals(net.conn_matrix.loc[f, t], 1)
+
+    def test_topo_order(self):
+
+        net = TestParseNetwork.network
+        nose.tools.assert_equals(sorted(net.topo_order), list(range(net.node_ids.size)))
+        position = np.empty_like(net.topo_order)
+        position[net.topo_order] = np.arange(net.topo_order.size)
+        rows, cols = net.conn_sparse.nonzero()
+        nose.tools.assert_true(np.all(position[rows] < position[cols]))
+
+    def test_get_node_index(self):
+
+        net = TestParseNetwork.network
+        np.testing.assert_array_equal(net.node_ids[net.get_node_index(net.node_ids[::-1])], net.node_ids[::-1])
+        nose.tools.assert_raises(ValueError, net.get_node_index, [-1])
+
+
+class TestParseNetworkCache(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.outdir = tempfile.mkdtemp()
+        for ext in ['.shp', '.shx', '.dbf', '.cpg']:
+            shutil.copy("../params/rivout" + ext, cls.outdir)
+        cls.fn = os.path.join(cls.outdir, "rivout.shp")
+        cls.nnz = utilsVector.ParseNetwork(cls.fn).conn_sparse.nnz
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_cache_roundtrip(self):
+
+        first = utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True)
+        nose.tools.assert_true(os.path.exists(TestParseNetworkCache.fn + '.npz'))
+
+        cached = utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True)
+        nose.tools.assert_is_not_none(cached._cached_attribute_table())
+        np.testing.assert_array_equal(cached.node_ids, first.node_ids)
+        np.testing.assert_array_equal(cached.topo_order, first.topo_order)
+        np.testing.assert_array_equal(cached.conn_sparse.toarray(), first.conn_sparse.toarray())
+        for field, col in first.attribute_table.items():
+            np.testing.assert_array_equal(cached.attribute_table[field], col)
+
+    def test_cache_skips_vector_file(self):
+
+        first = utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True)
+        calls = []
+        read_fiona = utilsVector.ReadVector._read_fiona_object
+        write_cache = utilsVector.utilsCache.write_npz_cache
+        utilsVector.ReadVector._read_fiona_object = lambda self: calls.append('read')
+        utilsVector.utilsCache.write_npz_cache = lambda *args, **kwargs: calls.append('write')
+        try:
+            cached = utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True)
+        finally:
+            utilsVector.ReadVector._read_fiona_object = read_fiona
+            utilsVector.utilsCache.write_npz_cache = write_cache
+        nose.tools.assert_equals(calls, [])
+        nose.tools.assert_equals(cached.crs, first.crs)
+        nose.tools.assert_equals(cached.driver, first.driver)
+        nose.tools.assert_equals(list(cached.schema['properties'].items()),
+                                 list(first.schema['properties'].items()))
+
+    def test_single_cache_write(self):
+
+        if os.path.exists(TestParseNetworkCache.fn + '.npz'):
+            os.remove(TestParseNetworkCache.fn + '.npz')
+        calls = []
+        write_cache = utilsVector.utilsCache.write_npz_cache
+
+        def counting_write(*args, **kwargs):
+            calls.append(sorted(args[2].keys()))
+            return write_cache(*args, **kwargs)
+
+        utilsVector.utilsCache.write_npz_cache = counting_write
+        try:
+            utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True)
+        finally:
+            utilsVector.utilsCache.write_npz_cache = write_cache
+        nose.tools.assert_equals(len(calls), 1)
+        nose.tools.assert_true('net__topo_order' in calls[0] and 'attr__ARCID' in calls[0])
+
+    def is_cached(self, hash_cache):
+        """Returns True if the sidecar cache is fresh, then loads the network, which rebuilds a stale cache"""
+        fingerprint = utilsVector.utilsCache.file_fingerprint(TestParseNetworkCache.fn, use_hash=hash_cache)
+        fresh = utilsVector.utilsCache.read_npz_cache(TestParseNetworkCache.fn + '.npz', fingerprint) is not None
+        network = utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True, hash_cache=hash_cache)
+        nose.tools.assert_equals(network.conn_sparse.nnz, TestParseNetworkCache.nnz)
+        return fresh
+
+    def test_stale_cache(self):
+
+        fn_dbf = TestParseNetworkCache.fn[:-4] + '.dbf'
+        for hash_cache in [False, True]:
+            utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True, hash_cache=hash_cache)
+            nose.tools.assert_true(self.is_cached(hash_cache))
+
+            # a new modification time invalidates the cache unless it is validated by contents
+            st = os.stat(TestParseNetworkCache.fn)
+            os.utime(TestParseNetworkCache.fn, (st.st_atime, st.st_mtime + 10))
+            nose.tools.assert_equals(self.is_cached(hash_cache), hash_cache)
+            # the stale cache was rebuilt
+            nose.tools.assert_true(self.is_cached(hash_cache))
+
+            # new contents with the same size, the date of last update in the dbf header
+            with open(fn_dbf, 'r+b') as f:
+                f.seek(1)
+                year = ord(f.read(1))
+                f.seek(1)
+                f.write(chr((year + 1) % 100))
+            nose.tools.assert_false(self.is_cached(hash_cache))
+            nose.tools.assert_true(self.is_cached(hash_cache))
+
+    def test_corrupt_cache(self):
+
+        utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True)
+        with open(TestParseNetworkCache.fn + '.npz', 'r+b') as f:
+            f.write(b'corrupted')
+        nose.tools.assert_equals(
+            utilsVector.ParseNetwork(TestParseNetworkCache.fn, use_cache=True).conn_sparse.nnz,
+            utilsVector.ParseNetwork(TestParseNetworkCache.fn).conn_sparse.nnz)
+
+
+class TestVectorParameterIO(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.fn = "../params/subsout.shp"
+        cls.vector = utilsVector.VectorParameterIO(cls.fn)
+
+    def test_get_parameters(self):
+
+        gridcode, ck0, bname = TestVectorParameterIO.vector.get_parameters(['GRIDCODE', 'hbv_ck0', 'Bname'])
+        features = list(TestVectorParameterIO.vector.read_features())
+        nose.tools.assert_equals(gridcode.dtype, np.int64)
+        nose.tools.assert_equals(ck0.dtype, np.float64)
+        nose.tools.assert_equals(list(gridcode), [f['properties']['GRIDCODE'] for f in features])
+        nose.tools.assert_equals(list(ck0), [f['properties']['hbv_ck0'] for f in features])
+        nose.tools.assert_equals(list(bname), [f['properties']['Bname'] for f in features])
+
+    def test_missing_field(self):
+
+        nose.tools.assert_raises(KeyError, TestVectorParameterIO.vector.get_parameters, ['not_a_field'])
+
+    def test_read_geometry(self):
+
+        vector = utilsVector.VectorParameterIO(TestVectorParameterIO.fn)
+        nose.tools.assert_is_none(vector.geometries)
+        table = vector.read_attribute_table(read_geometry=True)
+        nose.tools.assert_equals(len(vector.geometries), table['GRIDCODE'].size)
+        nose.tools.assert_equals(vector.geometries[0]['type'], 'Polygon')
+
+
+class TestModelVectorDatasets(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.outdir = tempfile.mkdtemp()
+        cls.datasets = utilsVector.ModelVectorDatasets("../params/rivout.shp", "../params/subsout.shp")
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_write_muskingum_parameters(self):
+
+        fn = os.path.join(TestModelVectorDatasets.outdir, "rivout.shp")
+        params = [{'ARCID': 3, 'e': 0.1}, {'ARCID': 3, 'e': 0.2}, {'ARCID': 5, 'ks': 1000.}]
+        TestModelVectorDatasets.datasets.write_muskingum_parameters(fn, params)
+
+        arcid, e, ks = utilsVector.VectorParameterIO(fn).get_parameters(['ARCID', 'e', 'ks'])
+        np.testing.assert_array_equal(e, np.where(arcid == 3, 0.1, 0.35))
+        np.testing.assert_array_equal(ks, np.where(arcid == 5, 1000., 82400))
+
+    def test_write_hvb_parameters_dataframe(self):
+
+        fn = os.path.join(TestModelVectorDatasets.outdir, "subsout.shp")
+        params = pd.DataFrame({'GRIDCODE': [2, 4], 'hbv_ck0': [1., 2.], 'hbv_pbase': [7, 8]}).set_index('GRIDCODE')
+        TestModelVectorDatasets.datasets.write_hvb_parameters(fn, params)
+
+        gridcode, ck0, ck1, pbase = \
+            utilsVector.VectorParameterIO(fn).get_parameters(['GRIDCODE', 'hbv_ck0', 'hbv_ck1', 'hbv_pbase'])
+        np.testing.assert_array_equal(ck0, np.select([gridcode == 2, gridcode == 4], [1., 2.], 10.))
+        np.testing.assert_array_equal(ck1, np.full(gridcode.size, 50.))
+        np.testing.assert_array_equal(pbase, np.select([gridcode == 2, gridcode == 4], [7, 8], 5))
+
+    def test_write_dataset_stream(self):
+
+        fn = os.path.join(TestModelVectorDatasets.outdir, "subsout_stream.shp")
+        vector = TestModelVectorDatasets.datasets.subsheds
+        n = vector.get_parameters(['GRIDCODE'])[0].size
+        vector.write_dataset_stream(fn, properties=({'hbv_ck0': float(i)} for i in range(n)),
+                                    columns={'hbv_ck1': np.arange(n) * 2.}, batch_size=7)
+
+        out = utilsVector.VectorParameterIO(fn)
+        ck0, ck1, elev = out.get_parameters(['hbv_ck0', 'hbv_ck1', 'Elev'])
+        np.testing.assert_array_equal(ck0, np.arange(n))
+        np.testing.assert_array_equal(ck1, np.arange(n) * 2.)
+        np.testing.assert_array_equal(elev, vector.get_parameters(['Elev'])[0])
+        for src, dst in zip(vector.read_features(), out.read_features()):
+            nose.tools.assert_equals(src['geometry'], dst['geometry'])
+
+    def test_join_parameters_arrays(self):
+
+        keys = np.array([1, 2, 3])
+        params = {'ARCID': np.array([3, 1]), 'e': np.array([0.3, 0.1])}
+        cols = utilsVector.join_parameters(keys, 'ARCID', utilsVector.ModelVectorDatasets.muskingum_parameters, params)
+        np.testing.assert_array_equal(cols['e'], [0.1, 0.35, 0.3])
+        np.testing.assert_array_equal(cols['ks'], [82400., 82400., 82400.])
+
+    def test_join_parameters_empty(self):
+
+        keys = np.array([1, 2, 3])
+        cols = utilsVector.join_parameters(keys, 'ARCID', utilsVector.ModelVectorDatasets.muskingum_parameters, [])
+        np.testing.assert_array_equal(cols['e'], [0.35, 0.35, 0.35])
+        np.testing.assert_array_equal(cols['ks'], [82400., 82400., 82400.])
+        nose.tools.assert_raises(KeyError, utilsVector.join_parameters, keys, 'ARCID',
+                                 utilsVector.ModelVectorDatasets.muskingum_parameters, [{'e': 0.1}])
@@ -0,0 +1,97 @@
+from utils import utilsZonal
+from rasterio.features import geometry_mask
+from rasterio.transform import from_bounds
+import numpy as np
+import fiona
+import tempfile
+import shutil
+import os
+import nose
+
+
+class TestZonalStatistics(object):
+    @classmethod
+    def setup_class(cls):
+        """This method is run once for each class before any tests are run"""
+        cls.fn = "../params/subsout.shp"
+        cls.shape = (124, 363)
+        with fiona.open(cls.fn) as src:
+            cls.transform = from_bounds(*(src.bounds + cls.shape[::-1]))
+            cls.features = list(src)
+        cls.zones = utilsZonal.ZonalStatistics(cls.fn, 'Subbasin', cls.shape, cls.transform)
+
+        rs = np.random.RandomState(3)
+        cls.values = rs.gamma(2., 3., (4,) + cls.shape)
+        cls.values[1, 40:60, 100:200] = np.nan
+        cls.outdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        """This method is run once for each class _after_ all tests are run"""
+        shutil.rmtree(cls.outdir)
+
+    def test_matches_polygon_masks(self):
+
+        zones = TestZonalStatistics.zones
+        values = TestZonalStatistics.values
+        res = zones.stats(values, ('count', 'sum', 'mean', 'min', 'max'))
+        nose.tools.assert_equals(res['mean'].shape, (4, zones.zone_ids.size))
+
+        for feat in TestZonalStatistics.features[::15]:
+            z = np.searchsorted(zones.zone_ids, feat['properties']['Subbasin'])
+            inside = geometry_mask([feat['geometry']], TestZonalStatistics.shape, TestZonalStatistics.transform,
+                                   invert=True) & (zones.labels == z)
+            nose.tools.assert_equals(zones.pixel_count[z], np.count_nonzero(inside))
+            for t in range(values.shape[0]):
+                v = values[t][inside]
+                v = v[np.isfinite(v)]
+                nose.tools.assert_equals(res['count'][t, z], v.size)
+                np.testing.assert_allclose(res['sum'][t, z], v.sum())
+                if v.size:
+                    np.testing.assert_allclose(res['mean'][t, z], v.mean())
+                    nose.tools.assert_equals(res['min'][t, z], v.min())
+                    nose.tools.assert_equals(res['max'][t, z], v.max())
+                else:
+                    nose.tools.assert_true(np.isnan(res['mean'][t, z]))
+
+    def test_single_map_and_nodata(self):
+
+        zones = TestZonalStatistics.zones
+        values = np.where(zones.labels % 2 == 0, -9999., 1.)
+        np.testing.assert_array_equal(zones.sum(values, nodata=-9999.),
+                                      np.where(np.arange(zones.zone_ids.size) % 2 == 0, 0, zones.pixel_count))
+        nose.tools.assert_raises(ValueError, zones.stats, values, ('median',))
+        nose.tools.assert_raises(ValueError, zones.mean, values[1:])
+
+    def test_cache(self):
+
+        fn_cache = os.path.join(TestZonalStatistics.outdir, 'zones.npz')
+        args = (TestZonalStatistics.fn, 'Subbasin', TestZonalStatistics.shape, TestZonalStatistics.transform)
+        first = utilsZonal.ZonalStatistics(*args, fn_cache=fn_cache)
+        nose.tools.assert_true(os.path.exists(fn_cache))
+        second = utilsZonal.ZonalStatistics(*args, fn_cache=fn_cache)
+        np.testing.assert_array_equal(second.labels, first.labels)
+        np.testing.assert_array_equal(second.zone_ids, first.zone_ids)
+        np.testing.assert_array_equal(second.labels, TestZonalStatistics.zones.labels)
+
+    def test_empty_last_zone(self):
+
+        fn = os.path.join(TestZonalStatistics.outdir, 'zones_empty.geojson')
+        schema = {'geometry': 'Polygon', 'properties': {'zone': 'int'}}
+        # zone 3 lies off the grid
+        squares = [(1, 0, 0, 5), (2, 5, 0, 5), (3, 20, 20, 5)]
+        with fiona.open(fn, 'w', driver='GeoJSON', schema=schema) as dst:
+            for zone, x0, y0, size in squares:
+                ring = [(x0, y0), (x0 + size, y0), (x0 + size, y0 + size), (x0, y0 + size), (x0, y0)]
+                dst.write({'geometry': {'type': 'Polygon', 'coordinates': [ring]}, 'properties': {'zone': zone}})
+        transform = from_bounds(0, 0, 10, 5, 10, 5)
+        zones = utilsZonal.ZonalStatistics(fn, 'zone', (5, 10), transform)
+        np.testing.assert_array_equal(zones.pixel_count, [25, 25, 0])
+
+        values = np.arange(50, dtype=np.float64).reshape(5, 10)
+        res = zones.stats(values, ('min', 'max'))
+        for z in range(2):
+            v = values[zones.labels == z]
+            nose.tools.assert_equals(res['min'][z], v.min())
+            nose.tools.assert_equals(res['max'][z], v.max())
+        nose.tools.assert_true(np.isnan(res['min'][2]) and np.isnan(res['max'][2]))
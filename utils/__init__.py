@@ -1,7 +1,12 @@
 from .utilsVector import ParseNetwork, VectorParameterIO, ModelVectorDatasets
-from .utilsRaster import RasterParameterIO, ModelRasterDatasetHBV
+from .utilsNetwork import NetworkReachability, NetworkScheduler
+from .routing import MuskingumCungeRouting
+from .utilsRaster import RasterParameterIO, ModelRasterDatasetHBV, HBVParameterCube, ActiveCells
+from .hbv import HBVSnowSoil
+from .utilsZonal import ZonalStatistics
+from .utilsCalendar import SimulationCalendar
 from .utilsOutputs import WriteOutputTimeSeries
-from .crop_coefficient import retrieve_crop_coefficient
+from .crop_coefficient import retrieve_crop_coefficient, CropCoefficientTable
 from .coupling import HydroEconCoupling, StrawFarmCoupling
 #from .utils import add_rr_model_parameters_to_shapefile
 #from .utilsRaster import write_array_as_tiff, write_structured_parameter_array
@@ -1,13 +1,15 @@
 import numpy as np
+from scipy import sparse
 import econengine as econ
 import utils
-from utils.crop_coefficient import retrieve_crop_coefficient
-from dateutil import parser
-import datetime
+from utils.crop_coefficient import seasonal_crop_coefficient_sum, get_crop_coefficient_table
+from utils import utilsCalendar
 import rasterio as rio
 from rasterio.features import rasterize
 import logging
 import json
+import copy
+import datetime
 
 
 __all__ = ['HydroEconCoupling', 'StrawFarmCoupling']
@@ -26,17 +28,29 @@ class StrawFarmCoupling(object):
 class HydroEconCoupling(object):
     """Couples the hydrologic and economic models"""
 
-    def __init__(self, routing_obj, water_users_lst, precip_arr, transform):
+    def __init__(self, routing_obj, water_users_lst, precip_arr, transform, active_cells=None):
+        """
+        :param routing_obj: parsed stream network
+        :param water_users_lst: list of dictionaries with the water user parameters
+        :param precip_arr: precipitation map with the grid of the hydrologic model
+        :param transform: affine transform of the grid
+        :param active_cells: optional, ActiveCells of the basin. Defaults to the cells with finite precipitation
+        """
 
         self.nodes = routing_obj
         self.water_users = water_users_lst
 
-        self.farms_table = self._build_water_user_matrix()
-        self.farm_idx = np.where(self.farms_table[:, 1:])
+        self.incidence = self._build_water_user_matrix()
+        # farms in incidence order, i.e. by node and then by position in the list of water users
+        self.farms = [econ.Farm(**self.water_users[i]) for i in self.incidence.user_index]
 
         # self.array_supplemental_irrigation = np.zeros_like(precip_arr)
 
-        self.water_user_mask = np.zeros_like(precip_arr)
+        if active_cells is None:
+            active_cells = utils.utilsRaster.ActiveCells(np.isfinite(precip_arr))
+        self.active_cells = active_cells
+
+        self.water_user_mask = np.zeros(np.shape(precip_arr), dtype=np.uint8)
 
         self.transform = transform
 
@@ -64,6 +78,8 @@ class HydroEconCoupling(object):
 
         :param water_user_shapes: shape or geojson filename
         :param id_field: name of field in 'water_user_sapes' with farm integer farm IDs
+        :param kwargs: optional, ``fill_value`` of pixels outside water users, ``fn_cache`` filename of an npz file
+         keeping the rasterized mask, or ``use_cache`` to keep it in ``water_user_shapes + '.mask.npz'``
 
         Returns
         =======
@@ -74,130 +90,534 @@ class HydroEconCoupling(object):
         return self
 
     def _build_water_user_matrix(self):
-        """ Loop through nodes in the network, find farms diverting from it and construct matrix of
-         farms associated to each node."""
-        nodes = []
-
-        for ids in self.nodes.conn.index:
-            li = [ids]
-            for farm in self.water_users:
-                if farm.get('source_id') == ids:
-                    li.append(econ.Farm(**farm))
-                else:
-                    li.append(0)
-            nodes.append(li)
-        arr_nodes = np.array(nodes)
-
-        return arr_nodes
-
-    def simulate_all_users(self, lst_scenarios):
+        """Finds the node each water user diverts from and returns the sparse incidence of nodes and farms.
+        Water users diverting from nodes that are not in the network are not coupled."""
+        node_ids = getattr(self.nodes, 'node_ids', None)
+        if node_ids is None:
+            node_ids = self.nodes.conn.index
+
+        return WaterUserIncidence(node_ids, [farm.get('source_id') for farm in self.water_users])
+
+    def simulate_all_users(self, lst_scenarios, pool=None):
         # type: (list) -> FarmCoupling
+        """Simulates every farm with the scenarios whose ``farm_id`` matches the farm source id and couples
+        the simulated farms to the network. See ``simulate_farms`` for parallel simulation with ``pool``.
+
+        Parameters
+        ==========
+        :param lst_scenarios: list of dictionaries with the observations of each scenario
+        :param pool: optional pool of workers, e.g. a ``multiprocessing.Pool``. Farms are simulated serially if None
+
+        Returns
+        =======
+        :returns: FarmCoupling object
+        """
+        self.farms = simulate_farms(self.farms, lst_scenarios, pool)
 
-        for obs in lst_scenarios:
-            for farm in self.farms_table[:, 1:][self.farm_idx]:
-                if obs.get("farm_id") == farm.source_id:
-                    farm.simulate(**obs)
+        return FarmCoupling(self.water_users, self.farms, self.incidence, self.water_user_mask,
+                            self.active_cells)
 
-        return FarmCoupling(self.water_users, self.farms_table, self.farm_idx, self.water_user_mask)
+    def simulate_scenario_batch(self, lst_scenario_sets, pool=None):
+        # type: (list) -> FarmCoupling
+        """Simulates copies of the farms with each set of scenarios, e.g. different prices, water costs or
+        allocations, and couples all of them to the network in a single batched FarmCoupling. Diversions and
+        supplemental irrigation of the returned object carry a leading scenario axis. The farms of this object
+        are not modified.
+
+        Parameters
+        ==========
+        :param lst_scenario_sets: list with a list of scenario dictionaries per scenario set, see ``simulate_all_users``
+        :param pool: optional pool of workers to simulate the farms of each scenario set
+
+        Returns
+        =======
+        :returns: FarmCoupling object
+        """
+        scenario_farms = [simulate_farms(copy.deepcopy(self.farms), lst_scenarios, pool)
+                          for lst_scenarios in lst_scenario_sets]
+
+        return FarmCoupling(self.water_users, scenario_farms[0], self.incidence, self.water_user_mask,
+                            self.active_cells, scenario_farms=scenario_farms)
 
     def _rasterize_water_user_polygons(self, fn_water_user_shapes, property_field_name, **kwargs):
         """
         returns a 2D array with rows and cols shape like precipitation inputs
         and vector features pointed by `fn_water_user_shapes` burned in. Burn-in values are these provided by
-        `property_field_name`. The function also updates self.array_supplemental_irrigation with the returned array.
+        `property_field_name`. The array has the smallest integer data type that holds the ids and the fill value.
+
+        If a cache file is given with ``fn_cache``, or ``use_cache`` is True, the mask is read from it while the
+        polygon file, id field, fill value, grid shape and transform do not change, and written to it otherwise.
         """
         fill = kwargs.get('fill_value', 0)
-        shapes = utils.VectorParameterIO(fn_water_user_shapes).read_features()
+        fn_cache = kwargs.get('fn_cache')
+        if fn_cache is None and kwargs.get('use_cache', False):
+            fn_cache = fn_water_user_shapes + '.mask.npz'
+
+        shape = self.water_user_mask.shape
+        fingerprint = utils.utilsCache.file_fingerprint(
+            fn_water_user_shapes, extra=[property_field_name, fill, list(shape), list(self.transform)[:6]])
+        if fn_cache is not None:
+            arrays = utils.utilsCache.read_npz_cache(fn_cache, fingerprint)
+            if arrays is not None:
+                self.water_user_mask = arrays['mask']
+                return self.water_user_mask
+
+        shapes = list(utils.VectorParameterIO(fn_water_user_shapes).read_features())
 
         try:
-            feats = ((g['geometry'], g['properties'][property_field_name]) for g in shapes)
+            feats = [(g['geometry'], g['properties'][property_field_name]) for g in shapes]
         except KeyError, e:
             print "field name %s does not exist in water user polygon file" %str(property_field_name)
             print e
             exit(-1)
 
+        dtype = utils.utilsRaster.min_integer_dtype([value for geom, value in feats] + [fill])
+        # rasterize does not burn 8 bit signed or 64 bit integers
+        burn_dtype = dtype if dtype.name in ('uint8', 'uint16', 'int16', 'int32', 'uint32') else np.float64
 
         t = self.water_user_mask = \
             rasterize(feats,
-                      self.water_user_mask.shape,
+                      shape,
                       fill=fill,
-                      transform=self.transform)
+                      transform=self.transform,
+                      dtype=burn_dtype).astype(dtype, copy=False)
+
+        if fn_cache is not None:
+            utils.utilsCache.write_npz_cache(fn_cache, fingerprint, {'mask': t}, compressed=True)
 
         return t
 
 
+def dispatch_scenarios(farms, lst_scenarios):
+    """Returns a list with the scenarios of each farm, in the order of ``lst_scenarios``. A scenario belongs to
+    every farm whose source id equals the scenario ``farm_id``.
+
+    :param farms: sequence of farms
+    :param lst_scenarios: list of dictionaries with the observations of each scenario
+    :return: list with a list of scenarios per farm
+    """
+    farms_of_id = {}
+    for i, farm in enumerate(farms):
+        farms_of_id.setdefault(farm.source_id, []).append(i)
+
+    scenarios = [[] for farm in farms]
+    for obs in lst_scenarios:
+        for i in farms_of_id.get(obs.get("farm_id"), []):
+            scenarios[i].append(obs)
+
+    return scenarios
+
+
+def simulate_farms(farms, lst_scenarios, pool=None):
+    """Simulates each farm with its scenarios, see ``dispatch_scenarios``, and returns the list of simulated farms
+    in the order of ``farms``.
+
+    Farms are independent, so they are dispatched together with ``pool.map``. ``pool`` can be a
+    ``multiprocessing.Pool``, a ``multiprocessing.pool.ThreadPool`` or any executor with an order preserving
+    ``map``. With a process pool the farms are pickled to the workers and the simulated copies, with the fitted
+    farm state, are returned in place of the originals.
+
+    :param farms: sequence of farms
+    :param lst_scenarios: list of dictionaries with the observations of each scenario
+    :param pool: optional pool of workers. Farms are simulated serially if None
+    :return: list of farms
+    """
+    farms = list(farms)
+    scenarios = dispatch_scenarios(farms, lst_scenarios)
+    rows = [i for i, obs in enumerate(scenarios) if obs]
+    tasks = [(farms[i], scenarios[i]) for i in rows]
+    if pool is None:
+        out = [_simulate_farm(t) for t in tasks]
+    else:
+        out = pool.map(_simulate_farm, tasks)
+    for i, farm in zip(rows, out):
+        farms[i] = farm
+
+    return farms
+
+
+def _simulate_farm(task):
+    """Simulates a farm with its scenarios in order, module level so that it can be pickled by process pools"""
+    farm, scenarios = task
+    for obs in scenarios:
+        farm.simulate(**obs)
+    return farm
+
+
+class WaterUserIncidence(object):
+    """Sparse incidence of the network nodes and the farms diverting water from them.
+
+    Farms are ordered by node row and then by position in the list of water users. ``matrix`` is a CSR
+    matrix with shape (nodes, farms) and a one where a farm diverts from a node, so that node totals of
+    per-farm values are a sparse matrix-vector product.
+    """
+
+    def __init__(self, node_ids, source_ids):
+        """
+        :param node_ids: ids of the network nodes
+        :param source_ids: id of the node each water user diverts from, one per water user
+        """
+        self.node_ids = np.asarray(node_ids)
+        self.n_nodes = self.node_ids.size
+        self.n_users = len(source_ids)
+
+        row_of_node = dict((node, row) for row, node in enumerate(self.node_ids.tolist()))
+        rows = np.array([row_of_node.get(source, -1) for source in source_ids], dtype=np.int64)
+        users = np.flatnonzero(rows >= 0)
+        order = np.lexsort((users, rows[users]))
+
+        self.user_index = users[order]
+        self.node_rows = rows[self.user_index]
+        self.n_farms = self.user_index.size
+        self.matrix = sparse.csr_matrix((np.ones(self.n_farms), (self.node_rows, np.arange(self.n_farms))),
+                                        shape=(self.n_nodes, self.n_farms))
+
+    def node_sum(self, farm_values, axis=0):
+        """
+        Returns the sum of per-farm values of the farms diverting from each node
+        :param farm_values: array of per-farm values
+        :param axis: axis of ``farm_values`` along farms
+        :return: array with nodes along ``axis``
+        """
+        farm_values = np.moveaxis(np.asarray(farm_values), axis, 0)
+        res = self.matrix.dot(farm_values.reshape(self.n_farms, -1)).reshape((self.n_nodes,) + farm_values.shape[1:])
+        return np.moveaxis(res, 0, axis)
+
+    def node_user_matrix(self, farm_values):
+        """
+        Returns a sparse matrix with shape (nodes, water users) with the value of each farm
+        :param farm_values: vector with one value per farm
+        :return: CSR matrix
+        """
+        return sparse.csr_matrix((farm_values, (self.node_rows, self.user_index)), shape=(self.n_nodes, self.n_users))
+
+
+class FarmRegistry(object):
+    """Per-crop attributes of the simulated farms in flat arrays.
+
+    Crops of all farms are stored one after the other, farm by farm, with the farm, node row and water user
+    of each crop. Crop dates are integer day ordinals. Diversions of all crops are then calculated with a few
+    vectorized operations and aggregated per farm, node or water user with ``np.bincount``. This class has the
+    following public methods:
+
+    - crop_coefficients(day): crop coefficient of every crop
+    - crop_diversions(day): water diverted for every crop
+    - sum_by_farm(values), sum_by_node(values), sum_by_user(values): aggregates of per-crop values
+    - split_by_farm(values): list with the per-crop values of each farm
+
+    Registries of several scenarios of the same farms are stacked with ``stack``. Per-crop attributes, and the
+    results of the methods above, then have a leading scenario axis.
+    """
+
+    # per-crop attributes, with a leading scenario axis in stacked registries
+    PER_CROP = ('start_day', 'cover_day', 'end_day', 'crop_id', 'irr_eff', 'irr', 'watersim', 'applied_water_factor')
+
+    def __init__(self, farms, node_rows, user_index, n_nodes, n_users):
+        """
+        :param farms: sequence of simulated farms
+        :param node_rows: row of the node each farm diverts from, one per farm
+        :param user_index: position of each farm in the list of water users
+        :param n_nodes: number of nodes of the network
+        :param n_users: number of water users
+        """
+        self.n_farms = len(farms)
+        self.n_nodes = n_nodes
+        self.n_users = n_users
+        # number of scenarios of stacked registries, None otherwise
+        self.n_scenarios = None
+
+        lst_crops = []
+        for farm in farms:
+            try:
+                crops = zip(farm.crop_start_date,
+                            farm.crop_cover_date,
+                            farm.crop_end_date,
+                            farm.crop_id,
+                            farm.irr_eff,
+                            farm.irr,
+                            farm.watersim)
+            except TypeError, e:
+                print "Water User %s does not have information on crop planting dates. Did you forget to " \
+                      "simulate a scenario?" %farm.name
+                exit(-1)
+            lst_crops.append(crops)
+
+        self.crops_per_farm = np.array([len(crops) for crops in lst_crops], dtype=np.int64)
+        self.crop_offsets = np.concatenate(([0], np.cumsum(self.crops_per_farm)))
+        self.farm_of_crop = np.repeat(np.arange(self.n_farms), self.crops_per_farm)
+        self.node_of_crop = np.asarray(node_rows, dtype=np.int64)[self.farm_of_crop]
+        self.user_of_crop = np.asarray(user_index, dtype=np.int64)[self.farm_of_crop]
+
+        crops = [crop for farm_crops in lst_crops for crop in farm_crops]
+        # each distinct date is parsed once, see utilsCalendar
+        self.start_day, self.cover_day, self.end_day = [
+            utilsCalendar.to_ordinals([crop[i] for crop in crops]).reshape(-1) for i in range(3)]
+        self.crop_id = np.array([crop[3] for crop in crops], dtype=np.int64)
+        self.irr_eff, self.irr, self.watersim = [
+            np.array([crop[i] for crop in crops], dtype=np.float64) for i in range(4, 7)]
+
+        # applied water factor of each crop, see FarmCoupling._calculate_applied_water_factor
+        self.applied_water_factor = seasonal_crop_coefficient_sum(
+            self.start_day, self.cover_day, self.end_day, self.crop_id) * self.irr_eff * self.irr
+
+    @classmethod
+    def stack(cls, registries):
+        """
+        Returns a registry with the per-crop attributes of the registries of several scenarios stacked along a
+        leading scenario axis. All registries must hold the same farms with the same number of crops.
+        :param registries: list of FarmRegistry objects
+        :return: FarmRegistry object
+        """
+        stacked = copy.copy(registries[0])
+        for registry in registries[1:]:
+            if not np.array_equal(registry.crops_per_farm, stacked.crops_per_farm):
+                raise ValueError("Scenarios must have the same farms with the same number of crops")
+        for attr in cls.PER_CROP:
+            setattr(stacked, attr, np.stack([getattr(registry, attr) for registry in registries]))
+        stacked.n_scenarios = len(registries)
+        return stacked
+
+    @property
+    def crop_axis(self):
+        """Axis along crops of per-crop arrays, 1 in stacked registries and 0 otherwise"""
+        return 0 if self.n_scenarios is None else 1
+
+    def _per_crop(self, arr, day):
+        """Returns per-crop ``arr`` with an axis appended for each axis of ``day``"""
+        return arr.reshape(arr.shape + (1,) * np.ndim(day))
+
+    def crop_coefficients(self, day):
+        """
+        Returns the crop coefficient of every crop
+        :param day: integer day ordinal or array of day ordinals
+        :return: array with the optional scenario axis, crops and the axes of ``day``
+        """
+        return get_crop_coefficient_table().coefficients(
+            day, *[self._per_crop(a, day) for a in (self.start_day, self.cover_day, self.end_day, self.crop_id)])
+
+    def crop_diversions(self, day):
+        """
+        Returns the water diverted for every crop, D = Wtot * Kc / f. Crops with a zero applied water
+        factor do not divert water
+        :param day: integer day ordinal or array of day ordinals
+        :return: array with the optional scenario axis, crops and the axes of ``day``
+        """
+        kc = self.crop_coefficients(day)
+        f = np.broadcast_to(self._per_crop(self.applied_water_factor, day), kc.shape)
+        kc = np.divide(kc, f, out=np.zeros_like(kc), where=f != 0)
+        return self._per_crop(self.watersim, day) * kc
+
+    def sum_by_farm(self, values):
+        """Returns the sum of per-crop ``values`` of each farm, crops along ``crop_axis`` of ``values``"""
+        return _sum_by_group(self.farm_of_crop, self.n_farms, values, self.crop_axis)
+
+    def sum_by_node(self, values):
+        """Returns the sum of per-crop ``values`` of each node, crops along ``crop_axis`` of ``values``"""
+        return _sum_by_group(self.node_of_crop, self.n_nodes, values, self.crop_axis)
+
+    def sum_by_user(self, values):
+        """Returns the sum of per-crop ``values`` of each water user, crops along ``crop_axis`` of ``values``"""
+        return _sum_by_group(self.user_of_crop, self.n_users, values, self.crop_axis)
+
+    def split_by_farm(self, values):
+        """Returns an object vector with the per-crop ``values`` of each farm, crops along the last axis"""
+        out = np.empty(self.n_farms, dtype=object)
+        for i in range(self.n_farms):
+            out[i] = values[..., self.crop_offsets[i]:self.crop_offsets[i + 1]]
+        return out
+
+
+def _sum_by_group(groups, n_groups, values, axis=0):
+    """Returns the sum of ``values`` of each group along ``axis``, with ``np.bincount`` for vectors and
+    a sparse matrix product otherwise"""
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        return np.bincount(groups, weights=values, minlength=n_groups)
+    values = np.moveaxis(values, axis, 0)
+    indicator = sparse.csr_matrix((np.ones(groups.size), (groups, np.arange(groups.size))),
+                                  shape=(n_groups, groups.size))
+    res = indicator.dot(values.reshape(values.shape[0], -1)).reshape((n_groups,) + values.shape[1:])
+    return np.moveaxis(res, 0, axis)
+
+
 class FarmCoupling(object):
 
-    def __init__(self, water_users_lst, farm_table, farm_idx, water_user_mask):
+    def __init__(self, water_users_lst, farms, incidence, water_user_mask, active_cells=None, scenario_farms=None):
+        """
+        :param water_users_lst: list of dictionaries with the water user parameters
+        :param farms: simulated farms in the order of ``incidence``
+        :param incidence: incidence of nodes and farms
+        :param water_user_mask: map with the water user id of each pixel
+        :param active_cells: optional, ActiveCells of the basin. Defaults to all cells of the mask
+        :param scenario_farms: optional, list with the simulated farms of each scenario for batched evaluation.
+         Diversions and supplemental irrigation then have a leading scenario axis
+        :type incidence: WaterUserIncidence
+        """
 
         self.water_users = water_users_lst
-        self.farms_table = farm_table
-        self.farm_idx = farm_idx
+        self.farms = farms
+        self.incidence = incidence
         self.water_user_mask = water_user_mask
 
-        self.applied_water_factor = np.zeros_like(self.farms_table)
+        if active_cells is None:
+            active_cells = utils.utilsRaster.ActiveCells(np.ones(np.shape(water_user_mask), dtype=bool))
+        self.active_cells = active_cells
+        # water user ids and supplemental irrigation over the active cells
+        self.water_user_cells = active_cells.compress(water_user_mask)
+        self.supplemental_irrigation = np.zeros(active_cells.size)
+
+        # position in ``water_users`` of the water user of each active cell, -1 outside water users
+        self.water_user_labels = self._label_water_user_cells()
+        # irrigated active cells and their water user, see set_irrigated_land()
+        self._irrigated_key = None
+        self._irrigated_cells = None
+        self._irrigated_labels = None
+        self._irrigated_count = None
+
+        self.array_supplemental_irrigation = np.zeros_like(self.water_user_mask, dtype=np.float64)
+
+        if scenario_farms is None:
+            self.registry = FarmRegistry(self.farms, incidence.node_rows, incidence.user_index,
+                                         incidence.n_nodes, incidence.n_users)
+        else:
+            self.registry = FarmRegistry.stack([FarmRegistry(f, incidence.node_rows, incidence.user_index,
+                                                             incidence.n_nodes, incidence.n_users)
+                                                for f in scenario_farms])
+        self.n_scenarios = self.registry.n_scenarios
 
-        self.array_supplemental_irrigation = np.zeros_like(self.water_user_mask)
+        # season-long diversions, see precompute_diversion_table()
+        self.first_day = None
+        self.diversion_table = None
+        self.farm_diversion_table = None
 
         self._calculate_applied_water_factor()
 
     def retrieve_water_diversion_per_node(self, date):
-        """Returns a vector and a matrix of length ``num_nodes`` and ``num_nodes x num_water_users`` with
-         total water diverted from each node and water diverted from each node and user,
-         respectively.
+        """Returns a matrix with shape ``2 x num_nodes`` with the node ids and the total water diverted from
+         each node, and a sparse matrix ``num_nodes x num_water_users`` with water diverted from each node
+         and user. In batched mode the node matrix has shape ``num_scenarios x 2 x num_nodes`` and the sparse
+         matrices are returned in a list with one matrix per scenario.
 
          Parameters
          ==========
-         :param date: date for which the diversions are required are required
+         :param date: date for which the diversions are required are required, string or any date accepted
+          by utilsCalendar.to_ordinal
 
+         Diversions are calculated for all crops at once over the flat arrays of ``registry``, or served from
+         the season table if ``date`` is in the days of ``precompute_diversion_table``.
          """
 
-        # obtain vector of crop coefficients
-        vect_retrieve_kcs = np.vectorize(retrieve_crop_coefficient, excluded=['current_date'])
+        day = utilsCalendar.to_ordinal(date)
+        if self.diversion_table is not None and 0 <= day - self.first_day < self.diversion_table.shape[-1]:
+            return self.retrieve_water_diversion_per_day(day - self.first_day)
 
-        # Obtains water simulated per crop
-        s = HydroEconCoupling.apply_to_all_members(self.farms_table[:, 1:][self.farm_idx], "crop_start_date")
-        c = HydroEconCoupling.apply_to_all_members(self.farms_table[:, 1:][self.farm_idx], "crop_cover_date")
-        e = HydroEconCoupling.apply_to_all_members(self.farms_table[:, 1:][self.farm_idx], "crop_end_date")
-        cropid = HydroEconCoupling.apply_to_all_members(self.farms_table[:, 1:][self.farm_idx], "crop_id")
+        # diversions per crop of all farms, see FarmRegistry
+        d = self.registry.crop_diversions(day)
 
-        current_kcs = vect_retrieve_kcs(date, s, c, e, cropid)
+        return self._diversion_tables(self.registry.sum_by_farm(d))
 
-        # Obtain water simulated per crop
-        Xw = np.vstack(
-            HydroEconCoupling.apply_to_all_members(
-                self.farms_table[:, 1:][self.farm_idx], "watersim"
-            )
-        )
+    def _diversion_tables(self, farm_diversions):
+        """Returns the node totals and node-user matrices of ``retrieve_water_diversion_per_node`` from the
+        diversions of each farm, with an optional leading scenario axis"""
+        node_ids = self.incidence.node_ids.astype(np.float64)
+        if self.n_scenarios is None:
+            Dtot = np.vstack((node_ids, self.incidence.node_sum(farm_diversions)))
+            return Dtot, self.incidence.node_user_matrix(farm_diversions)
 
-        # Obtain applied water factor
-        f = np.vstack(self.applied_water_factor[:, 1:][self.farm_idx])
+        totals = self.incidence.node_sum(farm_diversions, axis=1)
+        Dtot = np.stack((np.broadcast_to(node_ids, totals.shape), totals), axis=1)
+        D = [self.incidence.node_user_matrix(fd) for fd in farm_diversions]
+        return Dtot, D
 
-        # Calculated water diverted for each crop and farm
+    def precompute_diversion_table(self, start_date, num_days):
+        """Calculates the water diverted from each node and by each farm on every day of a season in one
+        vectorized pass and keeps the tables for ``retrieve_water_diversion_per_day``.
 
-        # diversions per per farm, crop and node
-        d = Xw * np.divide(current_kcs, f, where=f != 0)
-        D = self.farms_table.copy()
-        D[:, 1:][self.farm_idx] = tuple(d)
+        Parameters
+        ==========
+        :param start_date: first day of the season, see utilsCalendar.to_ordinal
+        :param num_days: number of days of the season
 
-        # Total diversions per node
-        # First sum all water diverted per crop in each farm
-        dtot = [fm.sum() for fm in d]
-        Dtot = self.farms_table.copy()
-        Dtot[:, 1:][self.farm_idx] = dtot
-        Dtot = np.vstack((Dtot[:, 0], Dtot[:, 1:].sum(axis=1)))
+        Returns
+        =======
+        :returns: array ``num_nodes x num_days`` with the water diverted from each node and day. Diversions of each
+         farm are kept in ``farm_diversion_table``, an array ``num_farms x num_days`` with farms in the order of
+         ``incidence``, which maps them to their node and water user. Both tables have a leading scenario axis
+         in batched mode
+        """
+        self.first_day = utilsCalendar.to_ordinal(start_date)
+        days = self.first_day + np.arange(num_days)
 
-        return Dtot, D
+        self.farm_diversion_table = self.registry.sum_by_farm(self.registry.crop_diversions(days))
+        self.diversion_table = self.incidence.node_sum(self.farm_diversion_table, axis=self.registry.crop_axis)
 
-    def retrieve_supplemental_irrigation_map(self, array_land_use, irr_ag_ids, water_diversion_table):
-        """Returns an array with the supplemental irrigation rate on pixels in array ``array_land_use`` with
-        id ``irr_ag_ids`` resulting from spreading evenly in space water diverted by water users as provided in
-        ``water_diversion_table``"""
+        return self.diversion_table
+
+    def retrieve_water_diversion_per_day(self, day_index):
+        """Returns the diversions of day ``day_index`` of the season set by ``precompute_diversion_table``, in the
+        format of ``retrieve_water_diversion_per_node``.
+
+         Parameters
+         ==========
+         :param day_index: integer index of the day in the season, 0 for ``start_date``
+        """
+        if self.diversion_table is None:
+            raise ValueError("Diversions were not precomputed, call precompute_diversion_table() first")
+        num_days = self.diversion_table.shape[-1]
+        if not 0 <= day_index < num_days:
+            raise ValueError("Day index %i is out of the precomputed season, days 0 to %i from %s"
+                             % (day_index, num_days - 1, datetime.date.fromordinal(self.first_day).isoformat()))
+
+        return self._diversion_tables(self.farm_diversion_table[..., day_index])
+
+    def _label_water_user_cells(self):
+        """Returns the position in ``water_users`` of the water user of each active cell, -1 outside water users.
+        Cells of water users sharing an id are labelled with the last of them"""
+        labels = np.full(self.water_user_cells.shape, -1, dtype=np.int64)
+        if not self.water_users:
+            return labels
+
+        ids = np.array([farm.get('id') for farm in self.water_users], dtype=np.float64)
+        # last position of each distinct id
+        unique_ids, last = np.unique(ids[::-1], return_index=True)
+        last = ids.size - 1 - last
+
+        pos = np.minimum(np.searchsorted(unique_ids, self.water_user_cells), unique_ids.size - 1)
+        found = unique_ids[pos] == self.water_user_cells
+        labels[found] = last[pos[found]]
+        return labels
+
+    def set_irrigated_land(self, array_land_use, irr_ag_ids):
+        """Precomputes the irrigated active cells of each water user, i.e. the cells of the water user mask with
+        land use in ``irr_ag_ids``, so that supplemental irrigation maps only need a gather per call.
 
+        Parameters
+        ==========
+        :param array_land_use: land use array or filename of a land use raster aligned with the water user mask
+        :param irr_ag_ids: land use ids of irrigated agriculture
+
+        Returns
+        =======
+        :returns: FarmCoupling object
+        """
+        lu = self._read_land_use(array_land_use)
+        irr_ag_ids = np.atleast_1d(irr_ag_ids)
+
+        labels = np.where(np.isin(self.active_cells.compress(lu), irr_ag_ids), self.water_user_labels, -1)
+        self._irrigated_cells = np.flatnonzero(labels >= 0)
+        self._irrigated_labels = labels[self._irrigated_cells]
+        self._irrigated_count = np.bincount(self._irrigated_labels, minlength=len(self.water_users))
+        # arrays that cannot change in place, e.g. those of the raster cache, are recognized in later calls
+        self._irrigated_key = (lu, tuple(irr_ag_ids.tolist())) if not lu.flags.writeable else None
+
+        return self
+
+    def _read_land_use(self, array_land_use):
+        """Returns the land use array of an array or a raster filename"""
         if isinstance(array_land_use, np.ndarray):
             lu = array_land_use
         elif isinstance(array_land_use, basestring):
-            lu = utils.RasterParameterIO(array_land_use).array
+            lu = utils.utilsRaster.raster_cache.get(array_land_use, 1)
 
         else:
             raise TypeError('Incorrect type for argument array_land_use')
@@ -205,25 +625,55 @@ class FarmCoupling(object):
         if lu.shape != self.water_user_mask.shape:
             raise ValueError("Land user rasters do not line up with shapes: " +
                              str(lu.shape) + str(self.water_user_mask.shape))
+        return lu
+
+    def retrieve_supplemental_irrigation_map(self, array_land_use, irr_ag_ids, water_diversion_table):
+        """Returns an array with the supplemental irrigation rate on pixels in array ``array_land_use`` with
+        id ``irr_ag_ids`` resulting from spreading evenly in space water diverted by water users as provided in
+        ``water_diversion_table``, either the matrix returned by ``retrieve_water_diversion_per_node`` or a vector
+        with the water applied by each water user, e.g. ``registry.sum_by_user(registry.crop_diversions(day))``.
+        In batched mode the matrices are given in a list, or the applied water in an array with one row per
+        scenario, and the maps are returned with a leading scenario axis.
+
+        The irrigated pixels of each water user are computed by ``set_irrigated_land`` and reused while the land
+        use is the same read-only array, e.g. a raster filename read through the raster cache, or if
+        ``array_land_use`` is None. Water is then spread with a single gather over the irrigated pixels of all
+        water users. Pixels are evaluated over the active cells only."""
+
+        if array_land_use is not None:
+            lu = self._read_land_use(array_land_use)
+            ids = tuple(np.atleast_1d(irr_ag_ids).tolist())
+            if self._irrigated_key is None or self._irrigated_key[0] is not lu or self._irrigated_key[1] != ids:
+                self.set_irrigated_land(lu, irr_ag_ids)
+        elif self._irrigated_cells is None:
+            raise ValueError("Land use is required if irrigated land was not set with set_irrigated_land()")
+
+        # water applied by each water user
+        if sparse.issparse(water_diversion_table):
+            applied_water = np.asarray(water_diversion_table.sum(axis=0), dtype=np.float64).ravel()
+        elif isinstance(water_diversion_table, list) and all(sparse.issparse(D) for D in water_diversion_table):
+            applied_water = np.vstack([np.asarray(D.sum(axis=0), dtype=np.float64) for D in water_diversion_table])
+        else:
+            applied_water = np.asarray(water_diversion_table, dtype=np.float64)
 
-        for i, farm in enumerate(self.water_users):
-            farm_id = farm.get('id')
-            m = np.count_nonzero(np.isin(lu, irr_ag_ids) & (self.water_user_mask == farm_id))
-            applied_water = np.apply_along_axis(np.sum, 0, water_diversion_table[:, i + 1]).sum()
-            if m == 0:
-                logging.warning("WARNING: water user with id %i is irrigating but water user mask does not contain"
-                      " irrigated pixels" %farm_id)
+        m = self._irrigated_count
+        for i in np.flatnonzero(m == 0):
+            logging.warning("WARNING: water user with id %i is irrigating but water user mask does not contain"
+                  " irrigated pixels" %self.water_users[i].get('id'))
 
-            self.array_supplemental_irrigation = np.where(np.isin(lu, irr_ag_ids) &
-                                                                 (self.water_user_mask == farm_id),
-                                                          applied_water / m,
-                                                          self.array_supplemental_irrigation)
+        rate = np.divide(applied_water, m, out=np.zeros_like(applied_water), where=m != 0)
+        if self.supplemental_irrigation.shape[:-1] != rate.shape[:-1]:
+            self.supplemental_irrigation = np.zeros(rate.shape[:-1] + (self.active_cells.size,))
+        self.supplemental_irrigation[..., self._irrigated_cells] = rate[..., self._irrigated_labels]
+
+        self.array_supplemental_irrigation = self.active_cells.expand(self.supplemental_irrigation, 0,
+                                                                      dtype=np.float64)
 
         return self.array_supplemental_irrigation
 
     def _calculate_applied_water_factor(self):
-        """Sets member variable ``applied_water_factor``, a masked matrix of arrays with the water diversion
-        adjustment factors per crop and farm.
+        """Sets member variable ``applied_water_factor``, a vector with an array per farm with the water
+        diversion adjustment factors per crop.
 
          The factor takes into account the irrigation efficient as well as the length of the crop period
           expressed as the accumulation of crop coefficients. The factor is defined as follows:
@@ -239,43 +689,17 @@ class FarmCoupling(object):
          D = Wtot_t * Kc_t / f
 
         Factor f and the subsequent calculation of D is calculated per crop. Thus, th function yields a
-        vector per farm, with one f per crop.
-
+        vector per farm, with one f per crop. Sum_t(Kc_t) is integrated in closed form for all crops of all farms
+        at once when the farm registry is built, see ``seasonal_crop_coefficient_sum``.
 
         """
 
-        Kcs = np.vectorize(retrieve_crop_coefficient)
-
-        lst_kc = []
-        for i, farm in enumerate(self.farms_table[:, 1:][self.farm_idx]):
-            try:
-                dates = zip(farm.crop_start_date,
-                            farm.crop_cover_date,
-                            farm.crop_end_date,
-                            farm.crop_id,
-                            farm.irr_eff,
-                            farm.irr)
-            except TypeError, e:
-                print "Water User %s does not have information on crop planting dates. Did you forget to " \
-                      "simulate a scenario?" %farm.name
-                exit(-1)
-
-            lst = []
-            for s, c, e, cropid, i_eff, i_mask, in dates:
-
-                date_array = [(parser.parse(s) + datetime.timedelta(days=x)).strftime("%m/%d/%Y")
-                              for x in range(0, (parser.parse(e) - parser.parse(s)).days + 1)]
-                lst.append(
-                      Kcs(date_array, s, c, e, cropid).sum() * i_eff * i_mask
-                )
-            lst_kc.append(np.array(lst))
-
-        self.applied_water_factor[:, 1:][self.farm_idx] = lst_kc
+        self.applied_water_factor = self.registry.split_by_farm(self.registry.applied_water_factor)
 
     def save_farm_list_json(self, fname):
         """Saves dictionary of farms to disk with name fname."""
 
-        res = [farm.write_farm_dict() for farm in self.farms_table[:, 1:][self.farm_idx]]
+        res = [farm.write_farm_dict() for farm in self.farms]
         d = {"farms": res}
 
         with open(fname, 'w') as json_out:
@@ -1,17 +1,166 @@
 from __future__ import division
 import pandas as pd
-from dateutil import parser
-import math
-from scipy.interpolate import interp1d
+import numpy as np
+import threading
 import pkg_resources
+from utils import utilsCalendar
 
 DATA_PATH = pkg_resources.resource_filename('utils', '/')
 
 
+class CropCoefficientTable(object):
+    """Crop coefficient curves of the agMet lookup table, parsed once.
+
+    Each crop has a piecewise-linear curve sampled every 10 percent of two periods: from planting to full
+    cover (columns 0 to 100 of the table) and from full cover to the end of the crop (columns 100 to 200).
+    Curves are kept in one array with a row per crop so that coefficients of many crops and days are
+    interpolated together. Days are integers on any common origin, e.g. date ordinals or days since the
+    start of the simulation.
+    """
+
+    # percent of period at the knots of each curve segment
+    KNOTS = np.arange(0, 110, 10)
+
+    def __init__(self, kc_table="crop_coefficients.txt"):
+        """
+        :param kc_table: Optional. Text lookup with crop coefficient curves. See default table for format.
+        """
+        df_kc = pd.read_csv(DATA_PATH + '/' + kc_table, sep='\t', index_col="crop_id")
+        df_kc = df_kc.sort_index()
+
+        self.crop_ids = df_kc.index.values.astype(np.int64)
+        # columns 0 to 200, the last two columns are the crop code and comment
+        self.curves = df_kc.iloc[:, :-2].values.astype(np.float64)
+        self.crop_codes = df_kc.iloc[:, -2].values
+
+    def crop_index(self, crop_ids):
+        """
+        Returns the rows of ``curves`` with the curves of ``crop_ids``
+        :param crop_ids: integer crop id or array of crop ids
+        :return: integer or array of integers
+        """
+        crop_ids = np.asarray(crop_ids).astype(np.int64)
+        idx = np.searchsorted(self.crop_ids, crop_ids)
+        found = self.crop_ids[np.minimum(idx, self.crop_ids.size - 1)] == crop_ids
+        if not np.all(found):
+            raise KeyError("Crop ids %s are not in the crop coefficient table" % np.unique(crop_ids[~found]))
+        return idx
+
+    def coefficients(self, days, start_days, cover_days, end_days, crop_ids):
+        """
+        Returns crop coefficients interpolated from the crop curves. All arguments are broadcast
+        against each other, e.g. a column of crops against a row of days.
+
+        :param days: integer days for the crop coefficients
+        :param start_days: integer days of crop planting
+        :param cover_days: integer days at which crops reach maximum coverage
+        :param end_days: integer days at which crops end, either harvested or dead
+        :param crop_ids: integer crop ids from the crop coefficient table
+        :return: array of crop coefficients, zero outside the crop periods
+        """
+        days, start, cover, end, rows = np.broadcast_arrays(
+            days, start_days, cover_days, end_days, self.crop_index(crop_ids))
+
+        growing = (days > start) & (days < cover)
+        covered = (days >= cover) & (days <= end)
+
+        # percent of the current period and first column of its curve segment
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.where(growing, (days - start) / (cover - start) * 100,
+                            np.where(covered & (end > cover), (days - cover) / (end - cover) * 100, 0.))
+        offset = np.where(growing, 0, 10)
+
+        # knot interval as chosen by interp1d, the left one on knots
+        k = np.clip(np.ceil(frac / 10).astype(np.int64) - 1, 0, 9)
+        y_lo = self.curves[rows, offset + k]
+        y_hi = self.curves[rows, offset + k + 1]
+        kc = (y_hi - y_lo) / 10 * (frac - self.KNOTS[k]) + y_lo
+
+        return np.where(growing | covered, kc, 0.)
+
+    def seasonal_sum(self, start_days, cover_days, end_days, crop_ids, first_days=None, last_days=None):
+        """
+        Returns the sum of the daily crop coefficients of each crop, without evaluating them day by day.
+
+        Days of a crop period fall on each segment of the curve as a run of consecutive integers, so the sum
+        over a segment is the number of days times the coefficient at its first knot plus the slope times the
+        sum of the day offsets, an arithmetic series. The result equals the sum of ``coefficients`` over every
+        day from ``first_days`` to ``last_days``. All arguments are broadcast against each other.
+
+        :param start_days: integer days of crop planting
+        :param cover_days: integer days at which crops reach maximum coverage
+        :param end_days: integer days at which crops end, either harvested or dead
+        :param crop_ids: integer crop ids from the crop coefficient table
+        :param first_days: optional, first day of the sum. Defaults to the planting days
+        :param last_days: optional, last day of the sum, included. Defaults to the end days
+        :return: array with the sum of the crop coefficients of each crop
+        """
+        first_days = start_days if first_days is None else first_days
+        last_days = end_days if last_days is None else last_days
+        start, cover, end, rows, first, last = [
+            np.asarray(a, dtype=np.int64)[..., None] for a in np.broadcast_arrays(
+                start_days, cover_days, end_days, self.crop_index(crop_ids), first_days, last_days)]
+
+        k = np.arange(10)
+        total = np.zeros(start.shape[:-1])
+        # day offsets j of each period on segment k are those with 10 * k < frac <= 10 * (k + 1)
+        for origin, length, j_min, j_max, offset in [
+                (start, cover - start, 1, cover - start - 1, 0),
+                (cover, end - cover, 0, end - cover, 10)]:
+            lo = np.maximum(np.maximum(length * k // 10 + 1, j_min), first - origin)
+            hi = np.minimum(np.minimum(length * (k + 1) // 10, j_max), last - origin)
+            if offset:
+                # the first day after full cover is on the first knot
+                lo = np.where(k == 0, np.maximum(j_min, first - origin), lo)
+            n = np.maximum(hi - lo + 1, 0)
+            sum_j = np.where(n > 0, (lo + hi) * n / 2, 0.)
+
+            y_lo = self.curves[rows, offset + k]
+            slope = (self.curves[rows, offset + k + 1] - y_lo) / 10
+            # a period of length zero only holds its first day, with offset zero
+            seg = n * y_lo + slope * (100 * sum_j / np.maximum(length, 1) - 10 * k * n)
+            total += seg.sum(axis=-1)
+
+        return total
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_crop_coefficient_table(kc_table="crop_coefficients.txt"):
+    """Returns the CropCoefficientTable of ``kc_table``, parsing the file only the first time it is requested
+    in the process"""
+    with _tables_lock:
+        if kc_table not in _tables:
+            _tables[kc_table] = CropCoefficientTable(kc_table)
+        return _tables[kc_table]
+
+
+def seasonal_crop_coefficient_sum(start_days, cover_days, end_days, crop_ids, first_days=None, last_days=None,
+                                  kc_table="crop_coefficients.txt"):
+    """Returns the sum of the daily crop coefficients of each crop from planting to the end of the crop, or
+    between ``first_days`` and ``last_days``. Days are integers, e.g. date ordinals, and all arguments are
+    arrays broadcast against each other. See CropCoefficientTable.seasonal_sum
+
+    :param start_days: integer days of crop planting
+    :param cover_days: integer days at which crops reach maximum coverage
+    :param end_days: integer days at which crops end, either harvested or dead
+    :param crop_ids: integer crop ids from AgMet crop coefficient lookup table
+    :param first_days: optional, first day of the sum
+    :param last_days: optional, last day of the sum, included
+    :param kc_table: Optional. Text lookup with crop coefficient curves. See default table for format.
+    :returns: array with the sum of crop coefficients of each crop
+    """
+    return get_crop_coefficient_table(kc_table).seasonal_sum(start_days, cover_days, end_days, crop_ids,
+                                                             first_days, last_days)
+
+
 def retrieve_crop_coefficient(current_date, start_date, cover_date, end_date,
                               crop_id, kc_table="crop_coefficients.txt"):
     """Returns crop coefficient for current_date interpolated from agMet lookup table. Dates are strings
-    with m/d/YYYY format if they are ambiguous (e.g. 06/03/12 is June, 3 2012)
+    with m/d/YYYY format if they are ambiguous (e.g. 06/03/12 is June, 3 2012), or any date accepted by
+    utilsCalendar.to_ordinal such as integer day ordinals. Each distinct string is parsed only once
 
     Parameters
     ==========
@@ -29,20 +178,6 @@ def retrieve_crop_coefficient(current_date, start_date, cover_date, end_date,
 
     """
 
-    df_kc = pd.read_table(DATA_PATH + '/' + kc_table, index_col="crop_id")
-    current_date = parser.parse(current_date)
-    start_date = parser.parse(start_date)
-    cover_date = parser.parse(cover_date)
-    end_date = parser.parse(end_date)
-    crop_id = int(crop_id)
-
-    if (current_date > start_date) & (current_date < cover_date):
-        frac_growing_season = (current_date - start_date).days / (cover_date - start_date).days * 100
-        f = interp1d(range(0, 110, 10), df_kc.loc[crop_id][:11])
-    elif (current_date >= cover_date) & (current_date <= end_date):
-        frac_growing_season = (current_date - cover_date).days / (end_date - cover_date).days * 100
-        f = interp1d(range(0, 110, 10), df_kc.loc[crop_id][10:-2])
-    else:
-        return 0.0
-
-    return f(frac_growing_season)
+    days = [utilsCalendar.to_ordinal(d) for d in (current_date, start_date, cover_date, end_date)]
+
+    return float(get_crop_coefficient_table(kc_table).coefficients(*(days + [int(crop_id)])))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Grid vectorized snow and soil moisture routines of the HBV rainfall-runoff model.
+
+The kernel takes the HBV parameter maps handled by ModelRasterDatasetHBV and advances all active
+cells of the grid together, one whole-array update per time step.
+
+"""
+from __future__ import division
+import numpy as np
+from utils import utilsRaster
+
+
+class HBVSnowSoil(object):
+
+    """HBV snow and soil moisture kernel over the active cells of a grid.
+
+    Parameter maps and states are stored as 1-D arrays over the active cells. Each day, and in every
+    active cell:
+
+    - precipitation falls as snow if temperature is below ``pp_temp_thres`` and as rain otherwise
+    - snow melts at ``ddf`` per degree above ``pp_temp_thres``
+    - rain and melt reaching the soil are split into recharge, the fraction (SM/FC)^beta, and soil storage
+    - actual evapotranspiration is potential evapotranspiration reduced linearly below LP*FC
+    - water above the soil capacity FC (``soil_max_wat``) becomes recharge
+
+    Inputs use consistent units, e.g. mm/day for precipitation and evapotranspiration, degrees C for
+    temperature and mm/degree/day for the degree-day factor. This class has the following public methods:
+
+    - step(precip, temp, pet): advances the grid one day
+    - run(precip, temp, pet): advances the grid over a block of days
+    """
+
+    def __init__(self, pp_temp_thres, ddf, soil_max_wat, soil_beta, aet_lp_param, mask=None,
+                 swe=0., soil_wat=0.):
+        """Initializes the kernel with 2-D parameter maps of identical shape.
+
+        :param pp_temp_thres: map with snow-rain temperature threshold
+        :param ddf: map with degree-day factor
+        :param soil_max_wat: map with soil maximum storage
+        :param soil_beta: map with soil recharge exponent
+        :param aet_lp_param: map with fraction of soil maximum storage above which aet equals pet
+        :param mask: optional, boolean map of active cells or ActiveCells object. Defaults to cells where all parameters are finite
+        :param swe: initial snow water equivalent, scalar or map
+        :param soil_wat: initial soil water storage, scalar or map
+        """
+        params = [np.squeeze(np.asarray(p, dtype=np.float64))
+                  for p in (pp_temp_thres, ddf, soil_max_wat, soil_beta, aet_lp_param)]
+        self.shape = params[0].shape
+        if any(p.shape != self.shape for p in params):
+            raise ValueError("Parameter maps have different shapes: %s" % [p.shape for p in params])
+
+        if mask is None:
+            mask = np.logical_and.reduce([np.isfinite(p) for p in params])
+        if not isinstance(mask, utilsRaster.ActiveCells):
+            mask = utilsRaster.ActiveCells(mask)
+        if mask.shape != self.shape:
+            raise ValueError("Shape mismatch!. Parameter shape is %s. Mask shape is %s" % (self.shape, mask.shape))
+        self.cells = mask
+        self.mask = mask.mask
+
+        self.pp_temp_thres, self.ddf, self.soil_max_wat, self.soil_beta, self.aet_lp_param = \
+            [self.cells.compress(p) for p in params]
+
+        # states over active cells
+        self.swe = self._compress(swe)
+        self.soil_wat = self._compress(soil_wat)
+
+    @classmethod
+    def from_raster_dataset(cls, dataset, **kwargs):
+        """
+        Initializes the kernel with the parameter maps of a ModelRasterDatasetHBV object.
+        Cells with the nodata value of any parameter map are inactive.
+        :param dataset: HBV raster dataset with the filenames of all parameter maps
+        :param kwargs: other arguments to the constructor
+        :return: HBVSnowSoil object
+        """
+        if any(fn is None for fn in dataset.get_parameter_filenames().values()):
+            raise ValueError("All HBV parameter maps are required to initialize the kernel")
+
+        cube = utilsRaster.HBVParameterCube(dataset)
+        mask = np.all((cube.array != cube.nodata[:, None, None]) & np.isfinite(cube.array), axis=0)
+        if 'mask' in kwargs:
+            mask &= kwargs.pop('mask')
+
+        return cls(*[cube[name] for name in cube.names], mask=mask, **kwargs)
+
+    def _compress(self, arr):
+        """Returns the values of a scalar or a map over the active cells"""
+        arr = np.asarray(arr, dtype=np.float64)
+        if arr.ndim == 0:
+            return np.full(self.cells.size, float(arr))
+        return self.cells.compress(arr) if arr.shape[-2:] == self.shape else arr
+
+    def _expand(self, arr, fill_value=np.nan):
+        """Returns a map, or a block of maps, with values ``arr`` on the active cells"""
+        return self.cells.expand(arr, fill_value)
+
+    def _advance(self, precip, temp, pet):
+        """Advances the states over active cells one day. Returns recharge and actual evapotranspiration"""
+        snow = temp < self.pp_temp_thres
+        rain = np.where(snow, 0., precip)
+        self.swe += np.where(snow, precip, 0.)
+
+        melt = np.minimum(self.ddf * np.maximum(temp - self.pp_temp_thres, 0.), self.swe)
+        self.swe -= melt
+
+        water = rain + melt
+        recharge = water * np.power(np.minimum(self.soil_wat / self.soil_max_wat, 1.), self.soil_beta)
+        self.soil_wat += water - recharge
+
+        aet = np.minimum(pet * np.minimum(self.soil_wat / (self.aet_lp_param * self.soil_max_wat), 1.),
+                         self.soil_wat)
+        self.soil_wat -= aet
+
+        excess = np.maximum(self.soil_wat - self.soil_max_wat, 0.)
+        self.soil_wat -= excess
+
+        return recharge + excess, aet
+
+    def step(self, precip, temp, pet):
+        """
+        Advances all active cells one day
+        :param precip: precipitation map
+        :param temp: temperature map
+        :param pet: potential evapotranspiration map
+        :return: tuple with maps of recharge, actual evapotranspiration, snow water equivalent and soil water
+        """
+        recharge, aet = self._advance(self._compress(precip), self._compress(temp), self._compress(pet))
+        return self._expand(recharge), self._expand(aet), self._expand(self.swe), self._expand(self.soil_wat)
+
+    def run(self, precip, temp, pet):
+        """
+        Advances all active cells over a block of days. Inputs are gathered over the active cells and
+        outputs scattered back to the grid once per block.
+        :param precip: precipitation maps, array with shape (days, rows, cols)
+        :param temp: temperature maps, array with shape (days, rows, cols)
+        :param pet: potential evapotranspiration maps, array with shape (days, rows, cols)
+        :return: tuple with blocks of maps of recharge, actual evapotranspiration, snow water equivalent
+         and soil water, each with shape (days, rows, cols)
+        """
+        precip, temp, pet = self._compress(precip), self._compress(temp), self._compress(pet)
+        days = precip.shape[0]
+        out = np.empty((4, days, self.swe.size))
+        for t in range(days):
+            out[0, t], out[1, t] = self._advance(precip[t], temp[t], pet[t])
+            out[2, t] = self.swe
+            out[3, t] = self.soil_wat
+
+        return tuple(self._expand(o) for o in out)
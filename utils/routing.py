@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Muskingum-Cunge routing over the stream network parsed by ParseNetwork.
+
+Flows of all reaches are advanced together, one topological level at a time, so that each time step
+costs one vectorized update per level instead of one per reach.
+
+"""
+from __future__ import division
+import numpy as np
+from utils.utilsNetwork import topological_levels
+
+
+class MuskingumCungeRouting(object):
+
+    """Routes lateral inflows through the stream network with the Muskingum-Cunge method.
+
+    Every network node stands for the reach starting at it. The inflow of a reach is its lateral
+    inflow plus the outflow of the reaches draining into it, and its outflow is
+
+    ::
+
+    Q_t+1 = C0 * I_t+1 + C1 * I_t + C2 * Q_t
+
+    with coefficients calculated from the reach parameters ``ks`` (K, storage constant in seconds)
+    and ``e`` (X, weighting factor) and the time step ``dt``.
+
+    Inflows can be vectors with one value per node or matrices with one row per node and one column
+    per ensemble member. This class has the following public methods:
+
+    - step(lateral): advances all reaches one time step
+    - route(laterals): advances all reaches over a series of time steps
+    """
+
+    def __init__(self, network, dt=86400., e=None, ks=None, initial_flow=None):
+        """Initializes the routing engine.
+
+        :param network: parsed stream network
+        :param dt: time step in seconds, defaults to one day
+        :param e: optional, Muskingum X of each reach in file order. Read from field 'e' if None
+        :param ks: optional, Muskingum K of each reach in file order. Read from field 'ks' if None
+        :param initial_flow: optional, initial flow of each node in ``network.node_ids`` order. Defaults to zero
+        :type network: ParseNetwork
+        """
+        self.network = network
+        self.node_ids = network.node_ids
+        self.dt = dt
+
+        if e is None:
+            e = network.get_parameters(['e'])[0]
+        if ks is None:
+            ks = network.get_parameters(['ks'])[0]
+
+        n = self.node_ids.size
+        self.e = np.empty(n)
+        self.ks = np.empty(n)
+        self.e[network.reach_rows] = e
+        self.ks[network.reach_rows] = ks
+
+        self.c0, self.c1, self.c2 = self.routing_coefficients(self.e, self.ks, dt)
+
+        self.levels = topological_levels(network.conn_sparse)
+        # rows of the transposed connectivity matrix, so that upstream outflows of a level are a product
+        upstream_conn = network.conn_sparse.T.tocsr().astype(np.float64)
+        self._upstream_by_level = [upstream_conn[rows] for rows in self.levels]
+
+        # Next two variables hold the state of the reaches after the last time step
+        self.outflow = None
+        self.inflow = None
+        if initial_flow is not None:
+            self.reset(initial_flow)
+
+    @staticmethod
+    def routing_coefficients(e, ks, dt):
+        """
+        Calculates the Muskingum-Cunge routing coefficients
+        :param e: Muskingum X, weighting factor
+        :param ks: Muskingum K, storage constant in seconds
+        :param dt: time step in seconds
+        :return: tuple with coefficients C0, C1 and C2
+        """
+        den = 2. * ks * (1. - e) + dt
+        c0 = (dt - 2. * ks * e) / den
+        c1 = (dt + 2. * ks * e) / den
+        c2 = (2. * ks * (1. - e) - dt) / den
+        return c0, c1, c2
+
+    def reset(self, initial_flow=0.):
+        """
+        Sets the flow of all reaches to a steady state
+        :param initial_flow: scalar, vector with one value per node or matrix with one row per node
+        :return: None
+        """
+        flow = np.asarray(initial_flow, dtype=np.float64)
+        if flow.ndim == 0:
+            flow = np.full(self.node_ids.size, float(flow))
+        self.outflow = flow.copy()
+        self.inflow = flow.copy()
+
+    def step(self, lateral):
+        """
+        Routes the lateral inflows of one time step through the network
+        :param lateral: lateral inflow of each node, vector or matrix with one row per node
+        :return: outflow of each node at the end of the time step, same shape as ``lateral``
+        """
+        lateral = np.asarray(lateral, dtype=np.float64)
+        if lateral.shape[0] != self.node_ids.size:
+            raise ValueError("Expected lateral inflows for %i nodes, got %i" % (self.node_ids.size, lateral.shape[0]))
+        if self.outflow is None:
+            self.reset(np.zeros_like(lateral))
+        elif self.outflow.shape != lateral.shape:
+            if self.outflow.ndim >= lateral.ndim:
+                raise ValueError("Lateral inflows with shape %s do not match the state of the reaches with shape %s"
+                                 % (lateral.shape, self.outflow.shape))
+            # a single state is shared by all ensemble members
+            shape = self.outflow.shape + (1,) * (lateral.ndim - self.outflow.ndim)
+            self.inflow = np.broadcast_to(self.inflow.reshape(shape), lateral.shape).copy()
+            self.outflow = np.broadcast_to(self.outflow.reshape(shape), lateral.shape).copy()
+
+        c0, c1, c2 = [c.reshape(c.shape + (1,) * (lateral.ndim - 1)) for c in (self.c0, self.c1, self.c2)]
+
+        inflow = np.empty_like(lateral)
+        outflow = np.zeros_like(lateral)
+        for rows, upstream in zip(self.levels, self._upstream_by_level):
+            # upstream reaches are on lower levels and already routed
+            inflow[rows] = lateral[rows] + upstream.dot(outflow)
+            outflow[rows] = c0[rows] * inflow[rows] + c1[rows] * self.inflow[rows] + c2[rows] * self.outflow[rows]
+
+        self.inflow = inflow
+        self.outflow = outflow
+
+        return outflow.copy()
+
+    def route(self, laterals):
+        """
+        Routes a series of lateral inflows through the network
+        :param laterals: array with the time steps along the first axis, followed by the
+         node axis and an optional ensemble member axis
+        :return: array with the outflow of each node and time step, same shape as ``laterals``
+        """
+        laterals = np.asarray(laterals, dtype=np.float64)
+        out = np.empty_like(laterals)
+        for t in range(laterals.shape[0]):
+            out[t] = self.step(laterals[t])
+        return out
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Functions to keep binary sidecar caches of parsed datasets.
+
+Caches are numpy ``.npz`` files stored together with a fingerprint of the files they were built
+from. A cache is only used while the fingerprint of the source files still matches.
+
+"""
+from __future__ import division
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import zipfile
+import numpy as np
+
+# companion files read together with a shapefile
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def _source_files(fn):
+    """Returns the list of files holding the dataset ``fn``, including shapefile companions"""
+    stem, ext = os.path.splitext(fn)
+    if ext.lower() != '.shp':
+        return [fn]
+    return [stem + e for e in SHAPEFILE_EXTENSIONS if os.path.exists(stem + e)]
+
+
+def file_fingerprint(fn, use_hash=False, extra=None):
+    """Returns a string identifying the current version of file ``fn``.
+
+    The fingerprint holds the size and modification time of the file and its shapefile
+    companions. If ``use_hash`` is True the modification time is replaced by a sha1 digest of
+    the contents, so that copies of a file share the fingerprint.
+
+    :param fn: filename of the dataset
+    :param use_hash: fingerprint file contents instead of modification times
+    :param extra: optional json serializable object with other values the cache depends on
+    :return: fingerprint
+    :rtype: str
+    """
+    lst = []
+    for f in _source_files(fn):
+        st = os.stat(f)
+        if use_hash:
+            sha = hashlib.sha1()
+            with open(f, 'rb') as src:
+                for chunk in iter(lambda: src.read(1 << 20), b''):
+                    sha.update(chunk)
+            lst.append([os.path.basename(f), st.st_size, sha.hexdigest()])
+        else:
+            lst.append([os.path.basename(f), st.st_size, repr(st.st_mtime)])
+
+    return json.dumps({'files': lst, 'extra': extra}, sort_keys=True)
+
+
+def read_npz_cache(fn_cache, fingerprint):
+    """Returns a dictionary with the arrays stored in ``fn_cache`` or None if the file does not exist,
+    cannot be read or was built from a different version of the source (fingerprint mismatch).
+
+    :param fn_cache: filename of the cache
+    :param fingerprint: fingerprint of the source files, see ``file_fingerprint``
+    :return: dictionary of numpy arrays or None
+    """
+    if not os.path.exists(fn_cache):
+        return None
+    try:
+        with np.load(fn_cache) as src:
+            if 'fingerprint' not in src.files or src['fingerprint'][()] != fingerprint:
+                return None
+            return dict((k, src[k]) for k in src.files if k != 'fingerprint')
+    except (IOError, OSError, ValueError, zipfile.BadZipfile) as e:
+        logging.warning("Ignoring unreadable cache %s: %s" % (fn_cache, e))
+        return None
+
+
+def write_npz_cache(fn_cache, fingerprint, arrays, compressed=False):
+    """Writes a dictionary of arrays and the fingerprint of their source to ``fn_cache``.
+
+    The file is written to a temporary file and moved in place so that readers never see a
+    partially written cache. Write errors are logged and otherwise ignored.
+
+    :param fn_cache: filename of the cache
+    :param fingerprint: fingerprint of the source files, see ``file_fingerprint``
+    :param arrays: dictionary of numpy arrays, keys must be valid file names
+    :param compressed: compress the arrays
+    :return: True if the cache was written
+    :rtype: bool
+    """
+    arrays = dict((str(k), v) for k, v in arrays.items())
+    arrays['fingerprint'] = np.array(fingerprint)
+    save = np.savez_compressed if compressed else np.savez
+
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(fn_cache)))
+        with os.fdopen(fd, 'wb') as dst:
+            save(dst, **arrays)
+        os.rename(tmp, fn_cache)
+    except (IOError, OSError) as e:
+        logging.warning("Could not write cache %s: %s" % (fn_cache, e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+    return True
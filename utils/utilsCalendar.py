@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Integer-day calendar shared by the coupling, crop coefficient and output modules.
+
+Dates are parsed once where they enter the model, e.g. scenario files or the simulation start date,
+and are carried as integer day ordinals (``datetime.date.toordinal``) or ``datetime64[D]`` arrays
+from there on. Strings are only produced again when outputs are written.
+
+"""
+from __future__ import division
+import numpy as np
+import datetime
+from dateutil import parser
+
+# ordinal of the numpy datetime64 epoch
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_US_PER_DAY = 86400 * 10 ** 6
+
+# ordinals of the date strings parsed so far
+_parsed = {}
+
+
+def to_ordinal(date):
+    """
+    Returns the day ordinal of a date. Strings are parsed with dateutil, m/d/YYYY if they are ambiguous,
+    and each distinct string is parsed only once per process
+    :param date: date string, datetime.date, datetime.datetime, numpy datetime64 or integer ordinal
+    :return: integer day ordinal
+    """
+    if isinstance(date, basestring):
+        try:
+            return _parsed[date]
+        except KeyError:
+            day = parser.parse(date).toordinal()
+            _parsed[date] = day
+            return day
+    if isinstance(date, datetime.date):
+        return date.toordinal()
+    if isinstance(date, np.datetime64):
+        return int(date.astype('datetime64[D]').astype(np.int64)) + EPOCH_ORDINAL
+    if isinstance(date, (int, long, np.integer)):
+        return int(date)
+    raise TypeError("Unsupported date %r of type %s" % (date, type(date).__name__))
+
+
+def to_ordinals(dates):
+    """
+    Returns the day ordinals of a sequence of dates, see ``to_ordinal``
+    :param dates: sequence of dates or array of datetime64 or integer ordinals
+    :return: array of int64 day ordinals
+    """
+    arr = np.asarray(dates)
+    if np.issubdtype(arr.dtype, np.datetime64):
+        return datetime64_to_ordinals(arr)
+    if np.issubdtype(arr.dtype, np.integer):
+        return arr.astype(np.int64)
+    return np.array([to_ordinal(d) for d in arr.ravel()], dtype=np.int64).reshape(arr.shape)
+
+
+def ordinals_to_datetime64(days):
+    """Returns an array of datetime64[D] with the dates of integer day ordinals"""
+    return (np.asarray(days, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]')
+
+
+def datetime64_to_ordinals(dates):
+    """Returns an array of int64 day ordinals with the dates of a datetime64 array"""
+    return np.asarray(dates).astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+
+
+def format_days(days, fmt="%Y-%m-%d"):
+    """
+    Formats integer day ordinals as date strings
+    :param days: integer day ordinal or array of day ordinals
+    :param fmt: strftime format of the strings
+    :return: list of strings
+    """
+    days = np.atleast_1d(np.asarray(days, dtype=np.int64))
+    if fmt == "%Y-%m-%d":
+        return list(np.datetime_as_string(ordinals_to_datetime64(days), unit='D'))
+    return [datetime.date.fromordinal(int(d)).strftime(fmt) for d in days]
+
+
+class SimulationCalendar(object):
+
+    """Integer-day calendar of a simulation.
+
+    Time steps are numbered from zero at the start date, and every step spans ``dt`` days. The calendar maps
+    time steps to day ordinals, datetime64 dates and formatted dates, and dates back to time steps. The time of
+    day of the start date is kept, so that steps shorter than a day fall on the right dates.
+    """
+
+    def __init__(self, start_date, dt=1):
+        """
+        :param start_date: date of the first time step, see ``to_ordinal``. Strings, datetimes and datetime64
+         keep their time of day
+        :param dt: time step size, days
+        """
+        self.start_day, self.start_time = _day_and_time(start_date)
+        self.dt = dt
+        # step size in microseconds, as datetime.timedelta rounds it
+        step = datetime.timedelta(days=dt)
+        self._dt_us = (step.days * 86400 + step.seconds) * 10 ** 6 + step.microseconds
+
+    def ordinals(self, num_steps):
+        """Returns an array with the day ordinals of the first ``num_steps`` time steps"""
+        elapsed = self.start_time + np.arange(num_steps, dtype=np.int64) * self._dt_us
+        return self.start_day + elapsed // _US_PER_DAY
+
+    def dates(self, num_steps):
+        """Returns a datetime64[D] array with the dates of the first ``num_steps`` time steps"""
+        return ordinals_to_datetime64(self.ordinals(num_steps))
+
+    def labels(self, num_steps, fmt="%Y-%m-%d"):
+        """Returns a list with the formatted dates of the first ``num_steps`` time steps"""
+        return format_days(self.ordinals(num_steps), fmt)
+
+    def step(self, date):
+        """
+        Returns the time step of a date
+        :param date: date, see ``to_ordinal``
+        :return: integer time step, the last step starting on or before ``date``
+        """
+        day, time = _day_and_time(date)
+        return int(((day - self.start_day) * _US_PER_DAY + time - self.start_time) // self._dt_us)
+
+
+def _day_and_time(date):
+    """Returns the day ordinal and the time of day in microseconds of a date, see ``to_ordinal``"""
+    if isinstance(date, basestring):
+        date = parser.parse(date)
+    if isinstance(date, np.datetime64):
+        us = date.astype('datetime64[us]')
+        time = int((us - us.astype('datetime64[D]')).astype(np.int64))
+        return to_ordinal(date), time
+    if isinstance(date, datetime.datetime):
+        return date.toordinal(), ((date.hour * 60 + date.minute) * 60 + date.second) * 10 ** 6 + date.microsecond
+    return to_ordinal(date), 0
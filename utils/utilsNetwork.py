@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""Classes to query and schedule work over the topology of the stream network parsed by ParseNetwork.
+
+The NetworkReachability class labels the nodes of the network with intervals over a depth-first
+ordering of the upstream trees, so that upstream sets, downstream paths and upstream accumulations
+can be answered without walking the connectivity matrix.
+
+The NetworkScheduler class groups the nodes in topological levels and in connected sub-trees
+that can be processed independently, and dispatches work on the sub-trees to a pool of workers.
+
+"""
+from __future__ import division
+import numpy as np
+from scipy import sparse
+
+
+def topological_levels(conn):
+    """Returns a list of arrays with the rows of the sparse connectivity matrix ``conn`` grouped by
+    topological level. Level 0 holds headwater nodes and each node appears one level after the deepest
+    node draining into it."""
+    n = conn.shape[0]
+    indegree = np.bincount(conn.indices, minlength=n)
+    frontier = np.flatnonzero(indegree == 0)
+
+    levels = []
+    visited = 0
+    while frontier.size:
+        levels.append(frontier)
+        visited += frontier.size
+        targets = conn[frontier].indices
+        indegree -= np.bincount(targets, minlength=n)
+        frontier = np.unique(targets[indegree[targets] == 0])
+
+    if visited != n:
+        raise ValueError("Stream network contains cycles, cannot sort it topologically")
+
+    return levels
+
+
+def downstream_rows(conn):
+    """Returns an array with the row each row of the sparse connectivity matrix ``conn`` drains to,
+    -1 for outlets. Raises ValueError if a node drains to more than one node."""
+    out_degree = np.diff(conn.indptr)
+    if np.any(out_degree > 1):
+        raise ValueError("Rows %s drain to more than one node, the network is not a tree" %
+                         np.flatnonzero(out_degree > 1).tolist())
+
+    downstream = np.full(conn.shape[0], -1, dtype=np.int64)
+    downstream[out_degree == 1] = conn.indices
+    return downstream
+
+
+class NetworkReachability(object):
+
+    """Reachability index of a stream network.
+
+    Every node drains to at most one downstream node, so the network is a forest of trees rooted
+    at the outlets. Nodes are numbered in depth-first preorder from the outlets upstream, and each node
+    gets the half-open interval ``[tin, tout)`` of preorder positions of the nodes draining to it,
+    itself included. Node ``u`` is upstream of node ``v`` if and only if ``tin[v] <= tin[u] < tout[v]``.
+
+    This class has the following public methods:
+
+    - upstream(node_id): ids of the nodes draining to node_id, O(k)
+    - downstream_path(node_id): ids of the nodes from node_id to the outlet, O(k)
+    - is_upstream(upstream_ids, downstream_ids): vectorized O(1) reachability test
+    - accumulate(values): sums of node values over the upstream set of every node, O(1) per node
+    """
+
+    def __init__(self, network):
+        """Builds the index from a ParseNetwork object.
+
+        :param network: parsed stream network
+        :type network: ParseNetwork
+        """
+        self.network = network
+        self.node_ids = network.node_ids
+
+        conn = network.conn_sparse
+        # downstream row of every node, -1 for outlets
+        self.downstream = downstream_rows(conn)
+
+        self.preorder, self.tin, self.tout, self.outlet = self._label_nodes(conn.T.tocsr())
+
+    def _label_nodes(self, upstream_conn):
+        """Returns the preorder of the nodes and the interval and outlet row of each node"""
+        n = self.node_ids.size
+        preorder = np.empty(n, dtype=np.int64)
+        tin = np.empty(n, dtype=np.int64)
+        outlet = np.empty(n, dtype=np.int64)
+
+        pos = 0
+        for root in np.flatnonzero(self.downstream < 0):
+            start = pos
+            stack = [root]
+            while stack:
+                v = stack.pop()
+                preorder[pos] = v
+                tin[v] = pos
+                pos += 1
+                stack.extend(upstream_conn.indices[upstream_conn.indptr[v]:upstream_conn.indptr[v + 1]][::-1])
+            outlet[preorder[start:pos]] = root
+
+        # subtree sizes accumulated from headwaters to outlets
+        size = np.ones(n, dtype=np.int64)
+        for v in self.network.topo_order:
+            d = self.downstream[v]
+            if d >= 0:
+                size[d] += size[v]
+
+        return preorder, tin, tin + size, outlet
+
+    def upstream(self, node_id, include_self=True):
+        """
+        Retrieves the nodes that drain to a node
+        :param node_id: id of the node
+        :param include_self: include node_id in the result
+        :return: array with node ids, in depth-first order from node_id upstream
+        """
+        v = self.network.get_node_index(node_id)
+        start = self.tin[v] if include_self else self.tin[v] + 1
+        return self.node_ids[self.preorder[start:self.tout[v]]]
+
+    def downstream_path(self, node_id, include_self=True):
+        """
+        Retrieves the nodes on the path from a node to the outlet of its basin
+        :param node_id: id of the node
+        :param include_self: include node_id in the result
+        :return: array with node ids, ordered downstream and ending at the outlet
+        """
+        v = int(self.network.get_node_index(node_id))
+        rows = [v] if include_self else []
+        v = self.downstream[v]
+        while v >= 0:
+            rows.append(v)
+            v = self.downstream[v]
+        return self.node_ids[np.asarray(rows, dtype=np.int64)]
+
+    def is_upstream(self, upstream_ids, downstream_ids):
+        """
+        Tests whether nodes drain to other nodes. A node is considered upstream of itself.
+        :param upstream_ids: node id or array of node ids
+        :param downstream_ids: node id or array of node ids, broadcast against upstream_ids
+        :return: boolean array
+        """
+        u = self.tin[self.network.get_node_index(upstream_ids)]
+        v = self.network.get_node_index(downstream_ids)
+        return (self.tin[v] <= u) & (u < self.tout[v])
+
+    def accumulate(self, values, node_ids=None):
+        """
+        Sums node values over the upstream set of nodes, e.g. the contributing area of each node
+        from the area of each subwatershed. Values of a reach attribute in file order can be placed
+        in node order with ``values[network.reach_rows] = attribute``.
+        :param values: array with one value per node, in ``node_ids`` order of the network
+        :param node_ids: optional, nodes for which the accumulation is returned. Defaults to all nodes
+        :return: array with the accumulated values
+        """
+        values = np.asarray(values)
+        if values.shape[0] != self.node_ids.size:
+            raise ValueError("Expected one value per node (%i), got %i" % (self.node_ids.size, values.shape[0]))
+
+        cum = np.zeros((values.shape[0] + 1,) + values.shape[1:], dtype=np.result_type(values, np.float64))
+        np.cumsum(values[self.preorder], axis=0, out=cum[1:])
+
+        rows = slice(None) if node_ids is None else self.network.get_node_index(node_ids)
+        return cum[self.tout[rows]] - cum[self.tin[rows]]
+
+
+class NetworkScheduler(object):
+
+    """Schedules work over independent parts of a stream network.
+
+    Nodes at the same topological level do not depend on each other, and neither do sub-trees
+    of the network that do not drain into one another. The scheduler keeps the node levels and cuts
+    the network into connected sub-trees (partitions) of about ``max_partition_size`` nodes. A partition
+    only depends on the partitions draining into its nodes, so partitions are run in waves where every
+    partition of a wave can run in parallel.
+
+    This class has the following public methods:
+
+    - run_partitions(func, pool): applies func to every partition, wave by wave, and returns the results
+    """
+
+    def __init__(self, network, max_partition_size=None):
+        """Builds the schedule from a ParseNetwork object.
+
+        :param network: parsed stream network
+        :param max_partition_size: approximate number of nodes per partition. If None, every basin
+         draining to a different outlet is a partition
+        :type network: ParseNetwork
+        :type max_partition_size: int
+        """
+        self.network = network
+        self.node_ids = network.node_ids
+        self.downstream = downstream_rows(network.conn_sparse)
+
+        self.levels = topological_levels(network.conn_sparse)
+        self.level_of = np.empty(self.node_ids.size, dtype=np.int64)
+        for i, rows in enumerate(self.levels):
+            self.level_of[rows] = i
+
+        self.partition_of, self.partitions, self.partition_outlets = self._partition(max_partition_size)
+
+        # partitions draining into each partition, in increasing order
+        n_parts = len(self.partitions)
+        receiving = self.downstream[self.partition_outlets]
+        inside = receiving >= 0
+        parents = self.partition_of[receiving[inside]]
+        children = np.flatnonzero(inside)
+        self.upstream_partitions = [children[parents == p] for p in range(n_parts)]
+
+        part_conn = sparse.csr_matrix((np.ones(children.size, dtype=np.int8), (children, parents)),
+                                      shape=(n_parts, n_parts))
+        self.waves = topological_levels(part_conn)
+
+    def _partition(self, max_partition_size):
+        """Cuts the network into connected sub-trees. Returns the partition of every row, the list of rows
+        of every partition in topological order and the outlet row of every partition."""
+        topo_order = self.network.topo_order
+        n = self.node_ids.size
+
+        cut = self.downstream < 0
+        if max_partition_size is not None:
+            # accumulate the size of the uncut sub-tree above every node, headwaters first,
+            # and cut it once it reaches the maximum size
+            pending = np.ones(n, dtype=np.int64)
+            for v in topo_order:
+                if pending[v] >= max_partition_size:
+                    cut[v] = True
+                elif self.downstream[v] >= 0:
+                    pending[self.downstream[v]] += pending[v]
+
+        # partitions are numbered by the topological position of their outlet
+        outlets = topo_order[cut[topo_order]]
+        partition_of = np.empty(n, dtype=np.int64)
+        partition_of[outlets] = np.arange(outlets.size)
+        for v in topo_order[::-1]:
+            if not cut[v]:
+                partition_of[v] = partition_of[self.downstream[v]]
+
+        by_partition = topo_order[np.argsort(partition_of[topo_order], kind='mergesort')]
+        bounds = np.cumsum(np.bincount(partition_of, minlength=outlets.size))[:-1]
+
+        return partition_of, np.split(by_partition, bounds), outlets
+
+    def run_partitions(self, func, pool=None):
+        """
+        Applies ``func(rows, upstream_results)`` to every partition. ``rows`` are the rows of the partition
+        nodes in topological order and ``upstream_results`` is the list of results of the partitions draining
+        into it, ordered by partition number, so that merges at confluences are deterministic.
+
+        Partitions of the same wave are dispatched together with ``pool.map``, so ``pool`` can be a
+        ``multiprocessing.Pool``, a ``multiprocessing.pool.ThreadPool`` or any executor with an order
+        preserving ``map``. With a process pool ``func`` and its results must be picklable.
+
+        :param func: function applied to each partition
+        :param pool: optional pool of workers. Partitions are processed serially if None
+        :return: list with the result of every partition
+        """
+        results = [None] * len(self.partitions)
+        for wave in self.waves:
+            tasks = [(func, self.partitions[p], [results[q] for q in self.upstream_partitions[p]]) for p in wave]
+            if pool is None:
+                out = [_call_partition(t) for t in tasks]
+            else:
+                out = pool.map(_call_partition, tasks)
+            for p, res in zip(wave, out):
+                results[p] = res
+
+        return results
+
+
+def _call_partition(task):
+    """Unpacks a partition task, module level so that it can be pickled by process pools"""
+    func, rows, upstream_results = task
+    return func(rows, upstream_results)
@@ -4,6 +4,7 @@ import pandas as pd
 import datetime
 from dateutil.parser import parse
 import json
+from utils.utilsCalendar import SimulationCalendar
 
 
 class WriteOutputTimeSeries(object):
@@ -24,6 +25,7 @@ class WriteOutputTimeSeries(object):
         self.conn_matrix = conn_matrix
         self.init_date = parse(init_date)
         self.dt = datetime.timedelta(days=dt)
+        self.calendar = SimulationCalendar(self.init_date, dt)
 
     def write_json(self, data):
         """
@@ -67,11 +69,12 @@ class WriteOutputTimeSeries(object):
         """
         lst_nodes = []
         data = np.array(data).T
+        # dates are formatted once and shared by all nodes
+        labels = self.calendar.labels(data.shape[-1], "%Y/%m/%d")
         for row, nodeid in enumerate(self.conn_matrix.index.values):
             node = {"id": nodeid}
             node["dates"] = \
-                [{"date": (self.init_date + ts * self.dt).strftime("%Y/%m/%d"),
-                  "flow": d} for ts, d in enumerate(data[row])]
+                [{"date": label, "flow": d} for label, d in zip(labels, data[row])]
 
             lst_nodes.append(node)
 
@@ -1,24 +1,224 @@
 from __future__ import division
 import rasterio as rio
+from rasterio.enums import Resampling
 import numpy as np
+import os
 import json
+import logging
+import threading
+from collections import OrderedDict
+from utils import utilsCache
+
+
+class RasterCache(object):
+    """
+    Least recently used cache of raster arrays shared by the whole process.
+
+    Arrays are keyed on the absolute path of the file, the band(s) read and the modification time
+    of the file, so that a file changed on disk is read again. Cached arrays are read-only so that
+    callers cannot modify the values seen by other callers. When the total size of the cached arrays
+    exceeds ``max_bytes`` the least recently used arrays are evicted. The shape, crs, transform and nodata
+    of each file are kept with ``metadata`` while the file does not change.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._metadata = {}
+        self._lock = threading.Lock()
+
+    def get(self, fn, band=None):
+        """
+        Returns the values of a raster file, reading it only if it is not in the cache
+        :param fn: filename of the raster
+        :param band: band or list of bands, as in rasterio read()
+        :return: read-only numpy array
+        """
+        path = os.path.abspath(fn)
+        bands = tuple(band) if isinstance(band, (list, tuple)) else band
+        key = (path, bands, os.stat(path).st_mtime)
+
+        with self._lock:
+            arr = self._entries.pop(key, None)
+            if arr is None:
+                # drop versions of the same raster read before the file changed
+                for k in [k for k in self._entries if k[:2] == key[:2]]:
+                    self.nbytes -= self._entries.pop(k).nbytes
+
+                with rio.open(path, 'r') as src:
+                    arr = src.read(band)
+                    self._metadata[key[::2]] = self._read_metadata(src)
+                arr.flags.writeable = False
+                if arr.nbytes > self.max_bytes:
+                    return arr
+                self.nbytes += arr.nbytes
+
+            self._entries[key] = arr
+            self._evict()
+
+        return arr
+
+    def metadata(self, fn):
+        """
+        Returns the metadata of a raster file, opening it only if it is not known or changed on disk
+        :param fn: filename of the raster
+        :return: dictionary with shape, crs, transform and nodata
+        """
+        path = os.path.abspath(fn)
+        key = (path, os.stat(path).st_mtime)
+
+        with self._lock:
+            meta = self._metadata.get(key)
+            if meta is None:
+                for k in [k for k in self._metadata if k[0] == path]:
+                    del self._metadata[k]
+                with rio.open(path, 'r') as src:
+                    meta = self._metadata[key] = self._read_metadata(src)
+
+        return meta
+
+    @staticmethod
+    def _read_metadata(src):
+        """Returns the metadata of an open rasterio dataset"""
+        return {'shape': src.shape, 'crs': src.crs, 'transform': src.transform, 'nodata': src.nodata}
+
+    def _evict(self):
+        """Removes least recently used arrays until the cache is within its memory budget"""
+        while self.nbytes > self.max_bytes and self._entries:
+            self.nbytes -= self._entries.popitem(last=False)[1].nbytes
+
+    def resize(self, max_bytes):
+        """
+        Changes the memory budget of the cache, evicting arrays if needed
+        :param max_bytes: maximum size of the cached arrays in bytes
+        :return: None
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Removes all arrays from the cache"""
+        with self._lock:
+            self._entries.clear()
+            self._metadata.clear()
+            self.nbytes = 0
+
+
+# cache shared by all readers in the process
+raster_cache = RasterCache()
+
+
+def min_integer_dtype(values):
+    """
+    Returns the smallest integer data type that holds all ``values``, or float64 if they are not integers
+    :param values: array or sequence of numbers
+    :return: numpy dtype
+    """
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.dtype(np.uint8)
+    if values.dtype.kind not in 'iub':
+        if not np.all(np.isfinite(values)) or not np.all(np.mod(values, 1) == 0):
+            return np.dtype(np.float64)
+    return np.result_type(np.min_scalar_type(int(values.min())), np.min_scalar_type(int(values.max())))
+
+
+class ActiveCells(object):
+    """
+    Compressed representation of the active (in-basin) cells of a grid.
+
+    Values over the active cells are stored as 1-D vectors in row-major order. ``index`` holds the
+    flat positions of the active cells in the grid and ``rows`` and ``cols`` their 2-D positions, so that
+    vectors are scattered back to the grid with a single assignment. Maps and blocks of maps with
+    leading axes, e.g. (days, rows, cols), are compressed along their last two axes.
+    """
+
+    def __init__(self, mask):
+        """
+        :param mask: boolean map, True on active cells
+        """
+        self.mask = np.asarray(mask, dtype=bool)
+        if self.mask.ndim != 2:
+            raise ValueError("Mask of active cells must be 2-D, got shape %s" % (self.mask.shape,))
+        self.shape = self.mask.shape
+        self.index = np.flatnonzero(self.mask)
+        self.rows, self.cols = np.unravel_index(self.index, self.shape)
+        self.size = self.index.size
+
+    @classmethod
+    def from_raster(cls, raster):
+        """
+        Initializes the active cells with the cells of a raster that are finite and not nodata
+        :param raster: ReadRaster object or filename of a raster, whose first band defines the active cells
+        :return: ActiveCells object
+        """
+        if isinstance(raster, basestring):
+            raster = ReadRaster(raster, 1, use_cache=True)
+        return raster.get_active_cells()
+
+    def compress(self, arr):
+        """
+        Returns the values of a map, or block of maps, over the active cells
+        :param arr: array with shape (..., rows, cols)
+        :return: array with shape (..., active cells)
+        """
+        arr = np.asarray(arr)
+        if arr.shape[-2:] != self.shape:
+            raise ValueError("Shape mismatch!. Active cells shape is %s. Array shape is %s" % (self.shape, arr.shape))
+        return arr.reshape(arr.shape[:-2] + (-1,))[..., self.index]
+
+    def expand(self, values, fill_value=0, dtype=None):
+        """
+        Scatters values over the active cells back to the grid
+        :param values: array with shape (..., active cells)
+        :param fill_value: value of the inactive cells
+        :param dtype: data type of the map, defaults to the data type of ``values``
+        :return: array with shape (..., rows, cols)
+        """
+        values = np.asarray(values)
+        if values.shape[-1:] != (self.size,):
+            raise ValueError("Expected values for %i active cells, got shape %s" % (self.size, values.shape))
+        out = np.full(values.shape[:-1] + (self.mask.size,), fill_value, dtype=values.dtype if dtype is None else dtype)
+        out[..., self.index] = values
+        return out.reshape(values.shape[:-1] + self.shape)
 
 
 class ReadRaster(object):
     """
-    Base class to read raster datasets, retrieve and keep metadata, and write geotiffs
+    Base class to read raster datasets, retrieve and keep metadata, and write geotiffs.
+
+    Only metadata is read on construction. The raster values are read the first time ``array``
+    is accessed, and can also be read by windows or blocks. With ``mmap`` the values of uncompressed,
+    untiled GeoTiffs are memory mapped instead of read into memory. With ``use_cache`` the values are
+    read through the process-wide ``raster_cache`` and are read-only.
     """
 
-    def __init__(self, fn_base_raster, band=None):
+    def __init__(self, fn_base_raster, band=None, mmap=False, use_cache=False):
         self.fn_base_raster = fn_base_raster
+        self.band = band
+        self.mmap = mmap
+        self.use_cache = use_cache
         # profile and shape are updated with call to _read_base_raster()
         self.profile = None
         self.shape = None
         self.affine = None
         self.nodata = -9999
-        self.array = None
+        self._array = None
         self._read_base_raster(band)
 
+    @property
+    def array(self):
+        """Raster values of the band(s) given to the constructor, read on first access"""
+        if self._array is None:
+            self._array = self._read_array(self.band)
+        return self._array
+
+    @array.setter
+    def array(self, value):
+        self._array = value
+
     def _read_base_raster(self, band):
         with rio.open(self.fn_base_raster, 'r') as src:
             self.profile = src.profile
@@ -26,7 +226,87 @@ class ReadRaster(object):
             self.transform = src.transform
             if src.nodata is not None:
                 self.nodata = int(src.nodata)
-            self.array = src.read(band)
+
+    def _read_array(self, band):
+        if self.use_cache:
+            return raster_cache.get(self.fn_base_raster, band)
+        if self.mmap:
+            try:
+                return self.read_memmap(band)
+            except ValueError as e:
+                logging.warning("Reading %s into memory: %s" % (self.fn_base_raster, e))
+
+        with rio.open(self.fn_base_raster, 'r') as src:
+            return src.read(band)
+
+    def read_window(self, window, band=None):
+        """
+        Reads a rectangular window of the raster without reading the rest of the file.
+
+        :param window: rasterio Window or tuple ((row_start, row_stop), (col_start, col_stop))
+        :param band: band or list of bands to read. Defaults to the band(s) given to the constructor
+        :return: numpy array with the values in the window
+        """
+        if band is None:
+            band = self.band
+        with rio.open(self.fn_base_raster, 'r') as src:
+            return src.read(band, window=window)
+
+    def iter_blocks(self, band=None):
+        """
+        Returns a generator over the internal blocks (strips or tiles) of the raster. Each item is a
+        tuple with the rasterio Window of the block and the array of values in it.
+
+        :param band: band or list of bands to read. Defaults to the band(s) given to the constructor
+        :return: generator of (window, array) tuples
+        """
+        if band is None:
+            band = self.band
+        with rio.open(self.fn_base_raster, 'r') as src:
+            bidx = band if isinstance(band, int) else 1
+            for ji, window in src.block_windows(bidx):
+                yield window, src.read(band, window=window)
+
+    def read_memmap(self, band=None):
+        """
+        Returns a read-only numpy memmap over the values of an uncompressed, untiled GeoTiff.
+        Raises ValueError if the layout of the file does not allow it, e.g. compressed or tiled files
+        or bands that are not stored one after the other.
+
+        :param band: band or list of bands. Defaults to the band(s) given to the constructor
+        :return: numpy memmap with the shape returned by rasterio for ``band``
+        """
+        if band is None:
+            band = self.band
+        with rio.open(self.fn_base_raster, 'r') as src:
+            if src.driver != 'GTiff' or src.compression is not None:
+                raise ValueError("only uncompressed GeoTiffs can be memory mapped")
+            block_rows, block_cols = src.block_shapes[0]
+            if block_cols != src.width:
+                raise ValueError("tiled GeoTiffs cannot be memory mapped")
+
+            bands = list(range(1, src.count + 1)) if band is None else np.atleast_1d(band).tolist()
+            dtype = np.dtype(src.dtypes[0])
+            if any(np.dtype(src.dtypes[b - 1]) != dtype for b in bands):
+                raise ValueError("bands with different data types cannot be memory mapped together")
+
+            height, width = src.height, src.width
+            n_blocks = -(-height // block_rows)
+            offsets = [int(src.get_tag_item('BLOCK_OFFSET_0_%i' % y, 'TIFF', bidx=b) or 0)
+                       for b in bands for y in range(n_blocks)]
+
+        block_bytes = block_rows * width * dtype.itemsize
+        band_bytes = height * width * dtype.itemsize
+        expected = [offsets[0] + i * band_bytes + y * block_bytes for i in range(len(bands)) for y in range(n_blocks)]
+        if offsets != expected:
+            raise ValueError("raster blocks are not stored contiguously")
+
+        with open(self.fn_base_raster, 'rb') as f:
+            byte_order = '<' if f.read(2) == b'II' else '>'
+
+        arr = np.memmap(self.fn_base_raster, dtype=dtype.newbyteorder(byte_order), mode='r',
+                        offset=offsets[0], shape=(len(bands), height, width))
+        return arr[0] if isinstance(band, int) else arr
 
     def update_raster(self, fn_new_raster, band=None):
         """
@@ -53,20 +333,74 @@ class ReadRaster(object):
         self.array = array
         self.nodata = int(nodata)
 
-    def _write_array_to_geotiff(self, fn_out, np_array):
+    def get_active_cells(self):
+        """
+        Returns the cells of the raster that are finite and not nodata
+        :return: ActiveCells object
+        """
+        values = self.array
+        if values.ndim == 3:
+            values = values[0]
+        return ActiveCells(np.isfinite(values) & (values != self.nodata))
+
+    def compress(self, active_cells=None):
+        """
+        Returns the raster values over the active cells
+        :param active_cells: optional, ActiveCells object. Defaults to the active cells of this raster
+        :return: array with shape (active cells,) or (bands, active cells)
+        """
+        if active_cells is None:
+            active_cells = self.get_active_cells()
+        return active_cells.compress(self.array)
+
+    def _write_array_to_geotiff(self, fn_out, np_array, dtype='float64', compress=None, predictor=None,
+                                tiled=False, blocksize=256, overviews=None, overview_resampling='nearest'):
         """
         Writes numpy arrays as tiff file using metadata from a template GeoTiff map.
 
+        A 2-D array is written as a single band and a 3-D array with shape (bands, rows, cols) as
+        a multi-band file. The template nodata value is dropped if it cannot be represented in ``dtype``.
+
         :param fn: filename of output tiff file, string
-        :param array: numpy array to be converted to tiff
+        :param array: numpy array to be converted to tiff, 2-D or 3-D
+        :param dtype: data type of the output file. If None, the data type of the array is kept
+        :param compress: optional, compression method such as 'deflate', 'lzw' or 'zstd'
+        :param predictor: optional, tiff predictor. Defaults to 2 for integers and 3 for floats if compressed
+        :param tiled: write internal tiles of ``blocksize`` instead of strips
+        :param blocksize: size of the internal tiles, a multiple of 16
+        :param overviews: optional, list of decimation factors of internal overviews, e.g. [2, 4, 8]
+        :param overview_resampling: name of the resampling method of the overviews
         :return: None
         """
-        if not isinstance(np_array, np.ndarray) or np_array.shape != self.shape:
-            raise ValueError("Shape mismatch!. Template shape is %s. Arrays shape is %s" % (src.shape, array.shape))
-        self.profile.update(driver='GTiff', count=1, dtype='float64')
+        if not isinstance(np_array, np.ndarray) or np_array.ndim not in (2, 3) or np_array.shape[-2:] != self.shape:
+            raise ValueError("Shape mismatch!. Template shape is %s. Arrays shape is %s" %
+                             (self.shape, getattr(np_array, 'shape', None)))
+
+        if np_array.ndim == 2:
+            np_array = np_array[np.newaxis]
+        dtype = np.dtype(np_array.dtype if dtype is None else dtype)
+
+        profile = self.profile.copy()
+        profile.update(driver='GTiff', count=np_array.shape[0], dtype=dtype.name)
+
+        nodata = profile.get('nodata')
+        if nodata is not None and dtype.kind in 'iu':
+            info = np.iinfo(dtype)
+            if not (info.min <= nodata <= info.max and float(nodata).is_integer()):
+                profile['nodata'] = None
+
+        if compress is not None:
+            profile['compress'] = compress
+            profile['predictor'] = predictor if predictor is not None else (3 if dtype.kind == 'f' else 2)
+        if tiled:
+            profile.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
         try:
-            with rio.open(fn_out, 'w', **self.profile) as dst:
-                dst.write(np_array.astype('float64'), 1)
+            with rio.open(fn_out, 'w', **profile) as dst:
+                dst.write(np_array.astype(dtype, copy=False))
+                if overviews:
+                    dst.build_overviews(overviews, getattr(Resampling, overview_resampling))
+                    dst.update_tags(ns='rio_overview', resampling=overview_resampling)
         except IOError as e:
             raise e
 
@@ -75,20 +409,29 @@ class RasterParameterIO(ReadRaster):
     """
     Class to manipulate raster model parameters
     """
-    def __init__(self, fn_base_raster, band=None):
-        super(RasterParameterIO, self).__init__(fn_base_raster, band)
+    def __init__(self, fn_base_raster, band=None, mmap=False, use_cache=False):
+        super(RasterParameterIO, self).__init__(fn_base_raster, band, mmap, use_cache)
 
-    def write_array_to_geotiff(self, fn_out, np_array):
+    def write_array_to_geotiff(self, fn_out, np_array, dtype='float64', compress=None, predictor=None,
+                               tiled=False, blocksize=256, overviews=None, overview_resampling='nearest'):
         # type: (basestring, object) -> None
         """
             Wrapper of function defined in parent class to write numpy arrays
              as tiff file using metadata from a template GeoTiff map.
 
             :param fn_out: filename of output tiff file, string
-            :param np_array: numpy array to be converted to tiff
+            :param np_array: numpy array to be converted to tiff, 2-D or (bands, rows, cols)
+            :param dtype: data type of the output file, None keeps the data type of the array
+            :param compress: optional, compression method such as 'deflate', 'lzw' or 'zstd'
+            :param predictor: optional, tiff predictor, chosen from the data type if None
+            :param tiled: write internal tiles instead of strips
+            :param blocksize: size of the internal tiles
+            :param overviews: optional, list of overview decimation factors
+            :param overview_resampling: resampling method of the overviews
             :return: None
             """
-        self._write_array_to_geotiff(fn_out, np_array)
+        self._write_array_to_geotiff(fn_out, np_array, dtype, compress, predictor,
+                                     tiled, blocksize, overviews, overview_resampling)
 
 
 class ModelRasterDatasetHBV(object):
@@ -131,16 +474,94 @@ class ModelRasterDatasetHBV(object):
         :param fn_out: filename to write the json dictionary
         :return: None
         """
-        self.filenamedic = {
-            'pp_temp_thres': self.fn_temp_thres,
-            'ddf': self.fn_ddf,
-            'soil_max_wat': self.fn_soil_max_wat,
-            'soil_beta': self.fn_soil_beta,
-            'aet_lp_param': self.fn_aet_lp_param
-        }
+        self.filenamedic = dict(self.get_parameter_filenames())
         with open(fn_out, 'w') as src:
             json.dump(self.filenamedic, src)
 
+    def get_parameter_filenames(self):
+        """
+        Returns an ordered dictionary with the parameter name keys and the path to files
+        holding the parameter map, None for maps that were not provided
+        :return: OrderedDict
+        """
+        return OrderedDict([
+            ('pp_temp_thres', self.fn_temp_thres),
+            ('ddf', self.fn_ddf),
+            ('soil_max_wat', self.fn_soil_max_wat),
+            ('soil_beta', self.fn_soil_beta),
+            ('aet_lp_param', self.fn_aet_lp_param)
+        ])
+
+
+class HBVParameterCube(object):
+    """
+    Stack of the HBV parameter maps of a ModelRasterDatasetHBV in one contiguous array with shape
+    (parameters, rows, cols). Maps are validated against the base map once, read with one pass per file
+    and can be saved to and reloaded from a single npz file.
+    """
+
+    def __init__(self, dataset, dtype=np.float64, fn_cache=None):
+        """
+        Initializes the cube with the parameter maps available in ``dataset``. If ``fn_cache`` is given
+        the cube is loaded from that file while the parameter maps do not change, and written to it otherwise.
+
+        :param dataset: HBV raster dataset
+        :param dtype: data type of the cube
+        :param fn_cache: optional, filename of the npz file holding the cube
+        :type dataset: ModelRasterDatasetHBV
+        """
+        fns = OrderedDict((name, fn) for name, fn in dataset.get_parameter_filenames().items() if fn is not None)
+        if not fns:
+            raise ValueError("The HBV raster dataset does not have parameter maps")
+
+        self.names = list(fns.keys())
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.shape = dataset.base_map.shape
+        self.transform = dataset.base_map.transform
+        self.crs = dataset.base_map.profile.get('crs')
+
+        fingerprint = utilsCache.file_fingerprint(dataset.fn_base_map, extra=[
+            [name, utilsCache.file_fingerprint(fn)] for name, fn in fns.items()] + [np.dtype(dtype).str])
+
+        arrays = None
+        if fn_cache is not None:
+            arrays = utilsCache.read_npz_cache(fn_cache, fingerprint)
+
+        if arrays is not None:
+            self.array = arrays['array']
+            self.nodata = arrays['nodata']
+        else:
+            self._read_maps(fns, dtype)
+            if fn_cache is not None:
+                utilsCache.write_npz_cache(fn_cache, fingerprint, {'array': self.array, 'nodata': self.nodata})
+
+    def _read_maps(self, fns, dtype):
+        """Validates the parameter maps against the base map and reads them into the cube. Values and metadata
+        come from ``raster_cache``, so maps already cached are not opened again. The cube is a copy of the
+        cached maps, which stay in the cache until evicted"""
+        self.array = np.empty((len(fns),) + self.shape, dtype=dtype)
+        self.nodata = np.empty(len(fns))
+        for i, (name, fn) in enumerate(fns.items()):
+            values = raster_cache.get(fn, 1)
+            meta = raster_cache.metadata(fn)
+            if meta['shape'] != self.shape:
+                raise ValueError("Shape mismatch!. Base map shape is %s. Map %s shape is %s" %
+                                 (self.shape, name, meta['shape']))
+            if meta['crs'] != self.crs or not meta['transform'].almost_equals(self.transform):
+                raise ValueError("Map %s is not aligned with the base map" % name)
+            self.nodata[i] = np.nan if meta['nodata'] is None else meta['nodata']
+            self.array[i] = values
+
+    def __getitem__(self, name):
+        """Returns the map of parameter ``name`` as a view of the cube"""
+        try:
+            return self.array[self.index[name]]
+        except KeyError:
+            raise KeyError("Parameter %s is not in the cube, available parameters are %s" % (name, self.names))
+
+    def __contains__(self, name):
+        return name in self.index
+
 
 
 
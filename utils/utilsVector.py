@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 """Classes to manipulate vector datasets used in daWUAP.
 
-The ReadVector base class reads and writes fiona geometry objects. This class is inherited by
-the other three classes in this module.
+The ReadVector base class reads and writes fiona geometry objects and keeps a columnar copy of the
+feature attributes. This class is inherited by the other two vector classes in this module.
 
 """
 from __future__ import division
-#import numpy as np
+from collections import OrderedDict
+import json
+import numpy as np
 import pandas as pd
+from scipy import sparse
 #import shapefile as shp
 import fiona
 from shapely.geometry import mapping, shape
+from utils import utilsCache
+from utils.utilsNetwork import topological_levels
 
 
 class ReadVector(object):
@@ -18,23 +23,128 @@ class ReadVector(object):
     """Base class to read vector datasets using Fiona.
 
     Reads and stores metadata from fiona objects, and facilitates the writing of vector files.
+    Feature attributes are read in a single pass the first time they are requested and kept as
+    one numpy array per field in ``attribute_table``. Optionally, parsed arrays are kept in a binary
+    sidecar cache next to the vector file.
 
 
     """
 
-    def __init__(self, fn_vector):
+    def __init__(self, fn_vector, use_cache=False, hash_cache=False):
         """The constructors requires a path to a file such as 'data/map_spain.shp'.
 
         An internal call to the protected ``_read_fiona_object()`` method opens the file and
         populates the metadata variables.
 
+        If ``use_cache`` is True, parsed arrays and the metadata are stored in the sidecar file
+        ``fn_vector + '.npz'`` and read from it instead of opening the vector file while the size and
+        modification time of the vector file, or its contents if ``hash_cache`` is True, do not change.
+
         """
         self.fn_vector = fn_vector
         # Next three variables are updated after the call to _read_fiona_object()
         self.crs = None
         self.schema = None
         self.driver = None
-        self._read_fiona_object()
+        # Next two variables are updated after the call to read_attribute_table()
+        self._attribute_table = None
+        self.geometries = None
+
+        self.fn_cache = None
+        self._fingerprint = None
+        self._cache = {}
+        # while True, arrays added to the cache are written to disk later in a single batch
+        self._hold_cache = False
+        if use_cache:
+            self.fn_cache = fn_vector + '.npz'
+            self._fingerprint = utilsCache.file_fingerprint(fn_vector, use_hash=hash_cache)
+            self._cache = utilsCache.read_npz_cache(self.fn_cache, self._fingerprint) or {}
+
+        if not self._load_cached_metadata():
+            self._read_fiona_object()
+            if use_cache:
+                meta = {'crs': dict(self.crs or {}), 'schema': self.schema, 'driver': self.driver}
+                self._cache['meta__vector'] = np.array(json.dumps(meta))
+
+    def _load_cached_metadata(self):
+        """Sets crs, schema and driver from the sidecar cache. Returns False if they are not cached"""
+        if 'meta__vector' not in self._cache:
+            return False
+        meta = json.loads(str(self._cache['meta__vector'][()]), object_pairs_hook=OrderedDict)
+        self.crs = dict(meta['crs'])
+        self.schema = dict(meta['schema'])
+        self.driver = meta['driver']
+        return True
+
+    @property
+    def attribute_table(self):
+        """Ordered dictionary with one numpy array per field of the vector file, read on first access"""
+        if self._attribute_table is None:
+            self._attribute_table = self._cached_attribute_table()
+        if self._attribute_table is None:
+            self.read_attribute_table()
+        return self._attribute_table
+
+    def _cached_attribute_table(self):
+        """Returns the attribute table stored in the sidecar cache or None if it is not cached"""
+        fields = list(self.schema['properties'].keys())
+        if not all('attr__' + f in self._cache for f in fields):
+            return None
+        return OrderedDict((f, _from_cache_column(self._cache['attr__' + f])) for f in fields)
+
+    def _update_cache(self, arrays):
+        """Adds ``arrays`` to the sidecar cache and writes it to disk, if caching is enabled"""
+        if self.fn_cache is None:
+            return
+        self._cache.update(arrays)
+        if not self._hold_cache:
+            utilsCache.write_npz_cache(self.fn_cache, self._fingerprint, self._cache)
+
+    def read_attribute_table(self, read_geometry=False):
+        """Reads the properties of all features in a single pass over the file and stores them
+        as a columnar table, one numpy array per field in schema order.
+
+        Geometries are not decoded unless ``read_geometry`` is True, in which case the fiona geometry
+        mappings are kept in ``geometries`` in feature order.
+
+        :param read_geometry: also read and keep the feature geometries
+        :type read_geometry: bool
+        :return: attribute table
+        :rtype: OrderedDict
+        """
+        fields = list(self.schema['properties'].keys())
+        rows = []
+        geoms = []
+        with fiona.open(self.fn_vector, 'r', ignore_geometry=not read_geometry) as src:
+            for feats in src:
+                props = feats['properties']
+                rows.append(tuple(props[f] for f in fields))
+                if read_geometry:
+                    geoms.append(feats['geometry'])
+
+        columns = zip(*rows) if rows else [() for f in fields]
+        self._attribute_table = OrderedDict(
+            (f, _as_column(col, self.schema['properties'][f])) for f, col in zip(fields, columns))
+        self.geometries = geoms if read_geometry else None
+
+        arrays = dict(('attr__' + f, _to_cache_column(col)) for f, col in self._attribute_table.items())
+        # columns with nulls in text fields are not cached, nor the rest of the table
+        if all(col is not None for col in arrays.values()):
+            self._update_cache(arrays)
+
+        return self._attribute_table
+
+    def get_parameters(self, params):
+        """
+        Retrieves the values of several parameters for all features with a single read of the file
+        :param params: sequence of field names
+        :return: list of numpy arrays, one per field in ``params``, in the order the features appear in the file
+        """
+        table = self.attribute_table
+        try:
+            return [table[p] for p in params]
+        except KeyError as e:
+            raise KeyError("Field %s does not exist in %s" % (e, self.fn_vector))
 
     def _read_fiona_object(self):
         """Returns an iterator over records in the vector file"""
@@ -69,11 +179,11 @@ class ReadVector(object):
         :param crs:
         :param driver:
         :param schema:
-        :param params: dictionary
+        :param params: sequence or iterator of feature dictionaries, consumed in file order
         :type fn: str
         :type driver: str
         :type schema: str
-        :type params: dict
+        :type params: iterable
         :return: None
         :rtype: None
 
@@ -88,49 +198,179 @@ class ReadVector(object):
 
         # TODO: solve problems writing projection information in shapefiles and geojson
         feature_iter = self._read_fiona_object()
+        if params is not None:
+            params = iter(params)
         with fiona.open(fn, 'w', crs=crs, driver=driver, schema=schema) as sink:
 
             for i, feats in enumerate(feature_iter):
                 geom = shape(feats['geometry'])
                 if params is not None:
-                    props = params[i]['properties']
+                    props = next(params)['properties']
                 else:
                     props = feats['properties']
                 sink.write({'properties': props, 'geometry': mapping(geom)})
 
+    def _write_fiona_stream(self, fn, crs=None, driver=None, schema=None, properties=None, columns=None,
+                            batch_size=1000):
+        """Writes a vector file using fn_vector as template, streaming the source features.
+
+        Source geometries are passed to the output as read, without a round-trip through shapely.
+        The properties of each source feature are updated with the next dictionary of the ``properties``
+        iterator and with the values of ``columns`` at the position of the feature, and only the fields
+        in ``schema`` are written. Features are written in batches of ``batch_size``.
+
+        :param fn: output file name
+        :param crs:
+        :param driver:
+        :param schema:
+        :param properties: iterator of dictionaries with the fields to add or update, one per feature
+        :param columns: dictionary of arrays with the fields to add or update, one value per feature
+        :param batch_size: number of features per write call
+        :type fn: str
+        :type driver: str
+        :type schema: dict
+        :type properties: iterable
+        :type columns: dict
+        :type batch_size: int
+        :return: None
+        :rtype: None
+        """
+        if crs is None:
+            crs = self.crs
+        if driver is None:
+            driver = self.driver
+        if schema is None:
+            schema = self.schema
+
+        fields = list(schema['properties'].keys())
+        if properties is not None:
+            properties = iter(properties)
+        if columns is not None:
+            # python scalars, fiona does not accept all numpy types
+            columns = dict((name, np.asarray(col).tolist()) for name, col in columns.items())
+
+        with fiona.open(self.fn_vector, 'r') as src:
+            with fiona.open(fn, 'w', crs=crs, driver=driver, schema=schema) as sink:
+
+                batch = []
+                for i, feats in enumerate(src):
+                    props = feats['properties']
+                    if properties is not None:
+                        props.update(next(properties))
+                    if columns is not None:
+                        for name, col in columns.items():
+                            props[name] = col[i]
+                    batch.append({'properties': OrderedDict((f, props.get(f)) for f in fields),
+                                  'geometry': feats['geometry']})
+                    if len(batch) == batch_size:
+                        sink.writerecords(batch)
+                        batch = []
+                if batch:
+                    sink.writerecords(batch)
+
 
 class ParseNetwork(ReadVector):
     """Returns a dataframe.
 
-    Class to parse the model stream network. It calculates the connectivity matrix
-    during the initialization and makes it available as a class variable.
+    Class to parse the model stream network. It calculates a sparse connectivity matrix
+    during the initialization and makes it available as a class variable together with the
+    node ids of its rows and a topological ordering of the nodes. The dense connectivity matrix
+    is built from the sparse one the first time ``conn_matrix`` is accessed.
     This class has the following public methods:
 
     - get_parameter(param): returns a list with the value of this parameter for all river reaches
+    - get_node_index(node_ids): returns the row positions of node ids in the connectivity matrix
     """
 
-    def __init__(self, fn_vector):
-        super(ParseNetwork, self).__init__(fn_vector)
-        self.conn_matrix = self._calc_connectivity_matrix()
-
-    def _calc_connectivity_matrix(self):
-        feature_iter = self._read_fiona_object()
-
-        lst_node_connections = []
+    def __init__(self, fn_vector, use_cache=False, hash_cache=False):
+        super(ParseNetwork, self).__init__(fn_vector, use_cache, hash_cache)
+        # Next five variables are updated after the call to _calc_sparse_connectivity()
+        self.node_ids = None
+        self.reach_rows = None
+        self.conn_sparse = None
+        self.topo_order = None
+        self._conn_matrix = None
+        if not self._load_cached_connectivity():
+            # the attribute table and the connectivity are written to the cache together
+            self._hold_cache = True
+            try:
+                self._calc_sparse_connectivity()
+            finally:
+                self._hold_cache = False
+            self._update_cache({'net__node_ids': self.node_ids,
+                                'net__reach_rows': self.reach_rows,
+                                'net__indptr': self.conn_sparse.indptr,
+                                'net__indices': self.conn_sparse.indices,
+                                'net__topo_order': self.topo_order})
+
+    @property
+    def conn_matrix(self):
+        """Dense connectivity matrix as a pandas dataframe with node ids as index and columns.
+        Kept for backwards compatibility, it is only built on first access."""
+        if self._conn_matrix is None:
+            self._conn_matrix = self._calc_connectivity_matrix()
+        return self._conn_matrix
+
+    def _calc_sparse_connectivity(self):
+        """Sets the sparse connectivity of the network from the FROM_NODE and TO_NODE fields.
+
+        ``node_ids`` holds the sorted ids of the network nodes, one per row of ``conn_sparse``,
+        ``reach_rows`` the row of the FROM_NODE of each reach in file order, ``conn_sparse`` a
+        CSR matrix with a 1 in (row of FROM_NODE, row of TO_NODE) and ``topo_order`` the rows
+        sorted so that every node comes before the nodes it drains to.
+        """
+        from_nodes, to_nodes = self.get_parameters(["FROM_NODE", "TO_NODE"])
+        from_nodes = from_nodes.astype(np.int64)
+        to_nodes = to_nodes.astype(np.int64)
 
-        for i, feats in enumerate(feature_iter):
-            geom = shape(feats['geometry'])
-            props = feats['properties']
-            lst_node_connections.append((props["FROM_NODE"], props["TO_NODE"]))
+        self.node_ids = np.unique(from_nodes)
+        self.reach_rows = self.get_node_index(from_nodes)
 
-        lstNodes = set(zip(*lst_node_connections)[0])
-        df = pd.DataFrame(0, index=lstNodes, columns=lstNodes)
         # drop the connections that go out of the basin to node 0
-        lst_node_connections = [i for i in lst_node_connections if i[1]>0]
-        for link in lst_node_connections:
-            df.loc[link] = 1
+        inside = to_nodes > 0
+        rows = self.reach_rows[inside]
+        cols = self.get_node_index(to_nodes[inside])
+
+        n = self.node_ids.size
+        conn = sparse.csr_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)), shape=(n, n))
+        # duplicated links are summed by the constructor
+        conn.data[:] = 1
+        self.conn_sparse = conn
+
+        self.topo_order = np.concatenate(topological_levels(conn))
+
+    def _load_cached_connectivity(self):
+        """Sets the sparse connectivity from the sidecar cache. Returns False if it is not cached"""
+        keys = ['net__node_ids', 'net__reach_rows', 'net__indptr', 'net__indices', 'net__topo_order']
+        if not all(k in self._cache for k in keys):
+            return False
+
+        self.node_ids = self._cache['net__node_ids']
+        self.reach_rows = self._cache['net__reach_rows']
+        indices = self._cache['net__indices']
+        n = self.node_ids.size
+        self.conn_sparse = sparse.csr_matrix((np.ones(indices.size, dtype=np.int8), indices,
+                                              self._cache['net__indptr']), shape=(n, n))
+        self.topo_order = self._cache['net__topo_order']
+        return True
+
+    def _calc_connectivity_matrix(self):
+        return pd.DataFrame(self.conn_sparse.toarray().astype(np.int64),
+                            index=self.node_ids, columns=self.node_ids)
 
-        return df
+    def get_node_index(self, node_ids):
+        """
+        Retrieves the rows of the connectivity matrix corresponding to a sequence of node ids
+        :param node_ids: node id or array of node ids
+        :return: array of row positions in ``node_ids`` order
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        idx = np.searchsorted(self.node_ids, node_ids)
+        found = self.node_ids[np.minimum(idx, self.node_ids.size - 1)] == node_ids
+        if not np.all(found):
+            raise ValueError("Nodes %s are not FROM_NODE of any reach in %s" %
+                             (np.unique(node_ids[~found]).tolist(), self.fn_vector))
+        return idx
 
     def get_parameter(self, param):
 
@@ -139,15 +379,30 @@ class ParseNetwork(ReadVector):
         :param param: string with name of the parameter to retrieve
         :return: list of parameter values in the order they appear in the river network dictionary
         """
-        feature_iter = self._read_fiona_object()
+        return self.get_parameters([param])[0].tolist()
+
+
+def _as_column(values, field_type):
+    """Returns a numpy array with the values of a field. Integer and float fields are stored with
+    native dtypes unless they contain nulls, other fields are stored as objects."""
+    dtype = {'int': np.int64, 'float': np.float64}.get(field_type.split(':')[0], object)
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return np.array(values, dtype=object)
 
-        lst_param = []
 
-        for i, feats in enumerate(feature_iter):
-            lst_param.append(
-                feats['properties'][param]
-            )
-        return lst_param
+def _to_cache_column(col):
+    """Returns a column in a form that can be stored without pickling, or None if it cannot"""
+    if col.dtype != object:
+        return col
+    arr = np.array(col.tolist(), dtype=np.unicode_) if col.size == 0 else np.array(col.tolist())
+    return arr if arr.dtype.kind in 'US' else None
+
+
+def _from_cache_column(col):
+    """Inverse of ``_to_cache_column``, text columns are returned as object arrays"""
+    return col.astype(object) if col.dtype.kind in 'US' else col
 
 
 class VectorParameterIO(ReadVector):
@@ -156,12 +411,14 @@ class VectorParameterIO(ReadVector):
     It has the following public methods:
 
     """
-    def __init__(self, fn_vector):
+    def __init__(self, fn_vector, use_cache=False, hash_cache=False):
         """
         Initializes the object with a polygon (basin) or multiline (network) vector dataset
         :param fn_vector: fn of vector dataset
+        :param use_cache: keep parsed attributes in a sidecar cache file ``fn_vector + '.npz'``
+        :param hash_cache: validate the cache with a hash of the file contents instead of size and modification time
         """
-        super(VectorParameterIO, self).__init__(fn_vector)
+        super(VectorParameterIO, self).__init__(fn_vector, use_cache, hash_cache)
 
     def read_features(self):
         """
@@ -182,11 +439,38 @@ class VectorParameterIO(ReadVector):
         """
         return self._write_fiona_object(fn, crs, driver, schema, params)
 
+    def write_dataset_stream(self, fn, crs=None, driver=None, schema=None, properties=None, columns=None,
+                             batch_size=1000):
+        """
+        Writes a vector file using fn_vector as template, pairing the source geometries with new
+        properties given as an iterator of dictionaries or as column arrays
+        :param fn: outfile name
+        :param crs:
+        :param driver:
+        :param schema:
+        :param properties: iterator of dictionaries with the fields to add or update, one per feature
+        :param columns: dictionary of arrays with the fields to add or update, one value per feature
+        :param batch_size: number of features per write call
+        :return: None
+        """
+        return self._write_fiona_stream(fn, crs, driver, schema, properties, columns, batch_size)
+
 
 class ModelVectorDatasets(object):
     """
     Class to handle the the manipulation of all vector dataset in the model
     """
+    # (field name, field type, default value) of the parameters added to each dataset
+    muskingum_parameters = [('e', 'float', 0.35),
+                            ('ks', 'float', 82400)]
+
+    hbv_parameters = [('hbv_ck0', 'float', 10.),
+                      ('hbv_ck1', 'float', 50.),
+                      ('hbv_ck2', 'float', 10000),
+                      ('hbv_hl1', 'float', 50),
+                      ('hbv_perc', 'float', 50),
+                      ('hbv_pbase', 'int', 5)]
+
     def __init__(self, fn_network=None, fn_subsheds=None):
 
         self.network = None
@@ -198,83 +482,94 @@ class ModelVectorDatasets(object):
             self.subsheds = VectorParameterIO(fn_subsheds)
 
     def write_muskingum_parameters(self, outfn, params=None):
-        # type: (str, list) -> None
+        # type: (str, object) -> None
         """
         Adds or updates the vector network file with the Muskingum-Cunge
         parameters. If params is not provided, the dataset is updated with default parameter
         values.
 
         :param outfn: filename for updated vector network
-        :param params: list of parameter dictionaries with format [{'ARCID': ID, 'e': value, 'ks': value},{}]
+        :param params: parameters keyed by ARCID, either a list of parameter dictionaries with format
+         [{'ARCID': ID, 'e': value, 'ks': value},{}], a dataframe with an ARCID column or index, or a
+         dictionary of arrays {'ARCID': [], 'e': [], 'ks': []}
         :return: None
         """
         # Check if network dataset is present
         if self.network is None:
             return
 
-        schema = self.network.schema.copy()
-        schema['properties']['e'] = 'float'
-        schema['properties']['ks'] = 'float'
-
-        lstDicts = []
-        feature_iter = self.network.read_features()
-        for i, feats in enumerate(feature_iter):
-            arc_id = feats['properties']['ARCID']
-            print("Processing reach feature id %i" % arc_id)
-            try:
-                val = (item for item in params if item['ARCID'] == arc_id).next()
-            except:
-                val = {}
-            feats['properties']['e'] = val.get('e', 0.35)
-            feats['properties']['ks'] = val.get('ks', 82400)
-            lstDicts.append(feats)
-
-        self.network.write_dataset(outfn, schema=schema, params=lstDicts)
+        self._write_parameters(self.network, outfn, 'ARCID', self.muskingum_parameters, params)
 
     def write_hvb_parameters(self, outfn, params=None):
-        # type: (str, list) -> None
+        # type: (str, object) -> None
         """
         Adds or updates the vector file of model subwatersheds with the hbv RR model parameters.
         If params is not provided, the dataset is updatd with default parameter values
 
         :param outfn: filename for updated vector network
-        :param params: list of parameter dictionaries with format []
+        :param params: parameters keyed by GRIDCODE, either a list of parameter dictionaries with format
+         [{'GRIDCODE': ID, 'hbv_ck0': value, ...},{}], a dataframe with a GRIDCODE column or index, or a
+         dictionary of arrays {'GRIDCODE': [], 'hbv_ck0': [], ...}
         :return: None
         """
         if self.subsheds is None:
             return
 
-        schema = self.subsheds.schema.copy()
-        schema['properties']['hbv_ck0'] = 'float'
-        schema['properties']['hbv_ck1'] = 'float'
-        schema['properties']['hbv_ck2'] = 'float'
-        schema['properties']['hbv_hl1'] = 'float'
-        schema['properties']['hbv_perc'] = 'float'
-        schema['properties']['hbv_pbase'] = 'int'
-
-        lstDicts = []
-        feature_iter = self.subsheds.read_features()
-        for i, feats in enumerate(feature_iter):
-            arc_id = feats['properties']['GRIDCODE']
-            print("Processing subwatershed feature id %i" %arc_id)
-            try:
-                val = (item for item in params if item['GRIDCODE'] == arc_id).next()
-            except:
-                val = {}
+        self._write_parameters(self.subsheds, outfn, 'GRIDCODE', self.hbv_parameters, params)
 
-            feats['properties']['hbv_ck0'] = val.get('hbv_ck0', 10.)
-            feats['properties']['hbv_ck1'] = val.get('hbv_ck1', 50.)
-            feats['properties']['hbv_ck2'] = val.get('hbv_ck2', 10000)
-            feats['properties']['hbv_hl1'] = val.get('hbv_hl1', 50)
-            feats['properties']['hbv_perc'] = val.get('hbv_perc', 50)
-            feats['properties']['hbv_pbase'] = val.get('hbv_pbase', 5)
-            lstDicts.append(feats)
+    @staticmethod
+    def _write_parameters(vector, outfn, key, parameters, params):
+        """Joins ``params`` to the features of ``vector`` on field ``key`` and streams the updated
+        features to ``outfn``"""
 
-        self.subsheds.write_dataset(outfn, schema=schema, params=lstDicts)
+        schema = vector.schema.copy()
+        schema['properties'] = schema['properties'].copy()
+        for name, field_type, default in parameters:
+            schema['properties'][name] = field_type
 
+        columns = join_parameters(vector.get_parameters([key])[0], key, parameters, params)
 
+        vector.write_dataset_stream(outfn, schema=schema, columns=columns)
 
 
+def join_parameters(keys, key, parameters, params=None):
+    """Returns an ordered dictionary with one array per parameter aligned with ``keys``.
+
+    ``params`` is indexed on the ``key`` field and reindexed to ``keys``. Parameters or keys missing
+    from ``params`` take the default value, and each column is cast to its field type.
+
+    :param keys: array with the key value of each feature, in file order
+    :param key: name of the key field, e.g. ARCID or GRIDCODE
+    :param parameters: list of (field name, field type, default value) tuples
+    :param params: list of dictionaries, dataframe or dictionary of arrays with a ``key`` column. Optional.
+    :return: ordered dictionary of numpy arrays
+    """
+    if params is None:
+        df = pd.DataFrame(columns=[key])
+    elif isinstance(params, pd.DataFrame):
+        df = params if key in params.columns else params.reset_index()
+    else:
+        df = pd.DataFrame(params)
+
+    if key not in df.columns:
+        if len(df):
+            raise KeyError("Parameters are not indexed by field %s" % key)
+        # an empty parameter list takes the defaults for every feature
+        df = pd.DataFrame(columns=[key])
+
+    # keep the first entry of a repeated key, as a linear search would
+    df = df.drop_duplicates(key).set_index(key).reindex(keys)
+
+    columns = OrderedDict()
+    for name, field_type, default in parameters:
+        if name in df.columns:
+            col = df[name].fillna(default).values
+        else:
+            col = np.full(len(keys), default)
+        columns[name] = col.astype(np.int64 if field_type == 'int' else np.float64)
+
+    return columns
+
 
 # def add_muskingum_model_parameters_to_network(vectorNetwork, outshp=''):
 #     """
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Zonal statistics of raster values over the subwatershed polygons.
+
+Polygons are rasterized once into a grid of zone labels aligned with the model rasters. Statistics
+of any number of maps or time steps are then single passes over the labelled pixels with
+``np.bincount`` and ``reduceat``, instead of one mask per polygon.
+
+"""
+from __future__ import division
+import numpy as np
+from collections import OrderedDict
+from rasterio.features import rasterize
+from utils import utilsCache
+from utils import utilsVector
+
+
+class ZonalStatistics(object):
+
+    """Per-zone aggregates of maps aligned with a grid.
+
+    Zones are the distinct values of field ``id_field`` of a polygon file, e.g. the subbasin ids of
+    subsout.shp. Pixels are assigned to the polygon covering their center, or to every polygon they
+    touch with ``all_touched``. Values can be single maps or blocks of maps with leading axes, e.g.
+    (days, rows, cols), and non-finite or nodata values are ignored. This class has the following
+    public methods:
+
+    - sum(values), mean(values), min(values), max(values): one statistic per zone
+    - stats(values, stats): several statistics from a single pass over the values
+    """
+
+    STATISTICS = ('count', 'sum', 'mean', 'min', 'max')
+
+    def __init__(self, fn_zones, id_field, shape, transform, fn_cache=None, all_touched=False):
+        """
+        Initializes the label grid. If ``fn_cache`` is given the grid is loaded from that file while the
+        polygons, field and grid do not change, and written to it otherwise.
+
+        :param fn_zones: shape or geojson polygon file with the zones
+        :param id_field: name of the field with the zone ids
+        :param shape: tuple with rows and columns of the grid
+        :param transform: affine transform of the grid
+        :param fn_cache: optional, filename of the npz file holding the label grid
+        :param all_touched: assign pixels to every polygon they touch
+        """
+        self.fn_zones = fn_zones
+        self.id_field = id_field
+        self.shape = tuple(shape)
+        self.transform = transform
+
+        fingerprint = utilsCache.file_fingerprint(fn_zones, extra=[id_field, list(self.shape),
+                                                                   list(transform)[:6], all_touched])
+        arrays = None
+        if fn_cache is not None:
+            arrays = utilsCache.read_npz_cache(fn_cache, fingerprint)
+
+        if arrays is not None:
+            self.zone_ids = arrays['zone_ids']
+            self.labels = arrays['labels']
+        else:
+            self._rasterize_zones(all_touched)
+            if fn_cache is not None:
+                utilsCache.write_npz_cache(fn_cache, fingerprint,
+                                           {'zone_ids': self.zone_ids, 'labels': self.labels}, compressed=True)
+
+        self._index_labels()
+
+    @classmethod
+    def from_raster(cls, fn_zones, id_field, raster, **kwargs):
+        """
+        Initializes the zones over the grid of a raster
+        :param fn_zones: shape or geojson polygon file with the zones
+        :param id_field: name of the field with the zone ids
+        :param raster: ReadRaster object with the grid
+        :param kwargs: other arguments to the constructor
+        :return: ZonalStatistics object
+        """
+        return cls(fn_zones, id_field, raster.shape, raster.transform, **kwargs)
+
+    def _rasterize_zones(self, all_touched):
+        """Burns the position of each zone id in ``zone_ids`` into the label grid, -1 outside all zones"""
+        features = list(utilsVector.VectorParameterIO(self.fn_zones).read_features())
+        try:
+            ids = np.array([feat['properties'][self.id_field] for feat in features])
+        except KeyError:
+            raise KeyError("field name %s does not exist in zone polygon file %s" % (self.id_field, self.fn_zones))
+
+        self.zone_ids, positions = np.unique(ids, return_inverse=True)
+        shapes = [(feat['geometry'], int(pos)) for feat, pos in zip(features, positions)]
+        if shapes:
+            self.labels = rasterize(shapes, self.shape, fill=-1, transform=self.transform,
+                                    all_touched=all_touched, dtype=np.int32)
+        else:
+            self.labels = np.full(self.shape, -1, dtype=np.int32)
+
+    def _index_labels(self):
+        """Sorts the labelled pixels by zone so that every zone is a contiguous segment"""
+        flat = self.labels.ravel()
+        pixels = np.flatnonzero(flat >= 0)
+        order = np.argsort(flat[pixels], kind='mergesort')
+        self._pixels = pixels[order]
+        self._zone_of_pixel = flat[self._pixels].astype(np.intp)
+        self._starts = np.searchsorted(self._zone_of_pixel, np.arange(self.zone_ids.size))
+        self.pixel_count = np.bincount(self._zone_of_pixel, minlength=self.zone_ids.size)
+
+    def stats(self, values, stats=('mean',), nodata=None):
+        """
+        Calculates several statistics of the values in each zone with a single pass over the values
+        :param values: map or block of maps with shape (..., rows, cols)
+        :param stats: names of the statistics, any of 'count', 'sum', 'mean', 'min' and 'max'
+        :param nodata: optional, value to ignore besides non-finite values
+        :return: ordered dictionary with an array of shape (..., zones) per statistic. Zones without valid
+         values have a sum and count of zero and nan for the other statistics
+        """
+        unknown = [s for s in stats if s not in self.STATISTICS]
+        if unknown:
+            raise ValueError("Unknown statistics %s, available statistics are %s" % (unknown, self.STATISTICS))
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape[-2:] != self.shape:
+            raise ValueError("Shape mismatch!. Zones shape is %s. Values shape is %s" % (self.shape, values.shape))
+        lead = values.shape[:-2]
+        nz = self.zone_ids.size
+
+        # values of the labelled pixels sorted by zone, one row per map
+        v = values.reshape((-1, self.labels.size))[:, self._pixels]
+        valid = np.isfinite(v)
+        if nodata is not None:
+            valid &= v != nodata
+        # one bincount over all maps, with the labels of map t shifted by t * zones
+        bins = (np.arange(v.shape[0])[:, None] * nz + self._zone_of_pixel).ravel()
+
+        out = OrderedDict()
+        count = np.bincount(bins, weights=valid.ravel(), minlength=v.shape[0] * nz).reshape(-1, nz)
+        empty = count == 0
+        for stat in stats:
+            if stat == 'count':
+                res = count
+            elif stat in ('sum', 'mean'):
+                res = np.bincount(bins, weights=np.where(valid, v, 0.).ravel(),
+                                  minlength=v.shape[0] * nz).reshape(-1, nz)
+                if stat == 'mean':
+                    res = np.where(empty, np.nan, res / np.where(empty, 1., count))
+            else:
+                ufunc, ignore = (np.minimum, np.inf) if stat == 'min' else (np.maximum, -np.inf)
+                res = np.full(count.shape, np.nan)
+                # reduceat over the zones with pixels only, the segment of an empty zone would cut the next one
+                labelled = self.pixel_count > 0
+                if np.any(labelled):
+                    res[:, labelled] = ufunc.reduceat(np.where(valid, v, ignore), self._starts[labelled], axis=1)
+                    res = np.where(empty, np.nan, res)
+            out[stat] = res.reshape(lead + (nz,))
+
+        return out
+
+    def sum(self, values, nodata=None):
+        """Returns the sum of the values in each zone, array with shape (..., zones)"""
+        return self.stats(values, ('sum',), nodata)['sum']
+
+    def mean(self, values, nodata=None):
+        """Returns the mean of the values in each zone, array with shape (..., zones)"""
+        return self.stats(values, ('mean',), nodata)['mean']
+
+    def min(self, values, nodata=None):
+        """Returns the minimum of the values in each zone, array with shape (..., zones)"""
+        return self.stats(values, ('min',), nodata)['min']
+
+    def max(self, values, nodata=None):
+        """Returns the maximum of the values in each zone, array with shape (..., zones)"""
+        return self.stats(values, ('max',), nodata)['max']